@@ -1,7 +1,10 @@
 from .env import Environment
 from .file import File, LogFile, LockFile, Directory, PluginDirectory, PackageDirectory, PackageFile
 from .plugin import PluginRegistry, Plugin, PluginManager
-from .config import ConfigNode, Config, ConfigEnv, ConfigFile, ConfigApplicator
+from .config import ConfigNode, FrozenConfigNode, Config, ConfigEnv, ConfigFile, ConfigCache, ConfigApplicator
+from .config import ConfigDirectory, ConfigSource
+from .config import REPLACE, APPEND, MERGE, KEEP_FIRST
+from .schema import Schema, SchemaError, Field
 from .state import State
 
 __all__ = [
@@ -9,6 +12,9 @@ __all__ = [
     "Directory", "PluginDirectory", "PackageDirectory", "PackageFile",
     "File", "LogFile", "LockFile",
     "PluginRegistry", "Plugin", "PluginManager",
-    "ConfigNode", "Config", "ConfigEnv", "ConfigFile", "ConfigApplicator",
+    "ConfigNode", "FrozenConfigNode", "Config", "ConfigEnv", "ConfigFile", "ConfigDirectory", "ConfigCache",
+    "ConfigSource", "ConfigApplicator",
+    "REPLACE", "APPEND", "MERGE", "KEEP_FIRST",
+    "Schema", "SchemaError", "Field",
     "State"
 ]
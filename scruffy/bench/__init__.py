@@ -0,0 +1,87 @@
+"""
+Bench
+-----
+
+Micro-benchmarks for Scruffy's hot paths.
+
+Run a suite from the command line like this:
+
+    $ python -m scruffy.bench config
+
+Results can be saved as JSON, and compared against a previous run to spot
+regressions:
+
+    $ python -m scruffy.bench --json before.json config
+    $ python -m scruffy.bench --compare before.json config
+
+Each suite is a module in this package with a `BENCHMARKS` list, populated by
+the `benchmark` decorator. Suites measure time by default; a suite whose
+module sets `UNIT = 'bytes'` measures memory instead, and its benchmarks'
+callables return the number of bytes they used.
+"""
+import datetime
+import importlib
+import platform
+import timeit
+
+
+SUITES = ['config', 'memory']
+
+
+def benchmark(registry, name, number=10000):
+    """
+    Decorator that registers a benchmark in a suite's `registry` list.
+
+    The decorated function does any setup that shouldn't be timed, and returns
+    a callable that performs one iteration of the operation being measured.
+    """
+    def decorator(func):
+        registry.append((name, func, number))
+        return func
+    return decorator
+
+
+def run(suite, repeat=5, match=None):
+    """
+    Run all the benchmarks in the named suite.
+
+    Returns a list of (name, seconds per iteration) tuples, or (name, bytes)
+    for memory suites, using the best of `repeat` runs for each benchmark. If
+    `match` is given, only benchmarks whose names contain it are run.
+    """
+    mod = suite_module(suite)
+    results = []
+    for name, setup, number in mod.BENCHMARKS:
+        if match and match not in name:
+            continue
+        func = setup()
+        if getattr(mod, 'UNIT', 'seconds') == 'bytes':
+            results.append((name, min(func() for i in range(repeat))))
+        else:
+            best = min(timeit.repeat(func, number=number, repeat=repeat))
+            results.append((name, best / number))
+    return results
+
+
+def suite_module(suite):
+    """
+    Import and return the module for the named suite.
+    """
+    return importlib.import_module('{}.{}'.format(__name__, suite))
+
+
+def report(results, label=None):
+    """
+    Build a machine-readable report from a dict of suite names and lists of
+    results from `run()`, with details of the environment they were run in.
+    """
+    return {
+        'label': label,
+        'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'units': dict((suite, getattr(suite_module(suite), 'UNIT', 'seconds')) for suite in results),
+        'results': dict((suite, dict(res)) for suite, res in results.items()),
+    }
+
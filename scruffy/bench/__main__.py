@@ -0,0 +1,65 @@
+import argparse
+import json
+import sys
+
+from . import SUITES, run, report, suite_module
+
+
+def fmt(value, unit):
+    if unit == 'bytes':
+        return '{:>12.1f} KiB'.format(value / 1024.0)
+    return '{:>12.3f} us'.format(value * 1e6)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='python -m scruffy.bench', description='Run Scruffy benchmarks')
+    parser.add_argument('suites', nargs='*', metavar='suite', help='suites to run (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of runs to take the best of')
+    parser.add_argument('-k', '--match', help='only run benchmarks whose names contain this')
+    parser.add_argument('--json', metavar='FILE', help="write the results to FILE as JSON ('-' for stdout)")
+    parser.add_argument('--label', help='label to include in the JSON results')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a previous JSON run')
+    args = parser.parse_args(args)
+
+    suites = args.suites or SUITES
+    for suite in suites:
+        if suite not in SUITES:
+            sys.exit("Unknown benchmark suite '{}' (available: {})".format(suite, ', '.join(SUITES)))
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+
+    quiet = args.json == '-'
+    results = {}
+    for suite in suites:
+        if not quiet:
+            print(suite)
+            if old:
+                print('    {:<70} {:>16} {:>16} {:>8}'.format('', 'before', 'after', 'ratio'))
+        before = old['results'].get(suite, {}) if old else {}
+        unit = getattr(suite_module(suite), 'UNIT', 'seconds')
+        results[suite] = []
+        for name, secs in run(suite, args.repeat, args.match):
+            results[suite].append((name, secs))
+            if quiet:
+                continue
+            if name in before:
+                print('    {:<70} {} {} {:>7.2f}x'.format(name, fmt(before[name], unit), fmt(secs, unit),
+                                                      before[name] / secs if secs else 0))
+            else:
+                print('    {:<70} {:>16}{}'.format(name, '', fmt(secs, unit)) if old else
+                      '    {:<70} {}'.format(name, fmt(secs, unit)))
+            sys.stdout.flush()
+
+    new = report(results, args.label)
+    if args.json == '-':
+        json.dump(new, sys.stdout, indent=4, sort_keys=True)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(new, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,437 @@
+"""
+Benchmarks for the config subsystem.
+"""
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import threading
+import yaml
+
+from functools import partial
+
+from . import benchmark
+from ..config import Config, ConfigApplicator, ConfigDirectory, ConfigEnv, ConfigFile, merge_dicts, update_dict
+from ..file import Directory, File, parse
+from ..schema import Field, Schema
+
+
+BENCHMARKS = []
+bench = partial(benchmark, BENCHMARKS)
+
+
+def nested(depth, width=5, leaf=1):
+    """
+    Build a nested dict `depth` levels deep with `width` keys at each level.
+    """
+    if depth == 0:
+        return leaf
+    return dict(('k{}'.format(j), nested(depth - 1, width, leaf)) for j in range(width))
+
+
+def document(sections, leaves=20):
+    """
+    Build a config-like document with `sections` top-level sections, each
+    containing a mix of `leaves` scalars and a small list.
+    """
+    doc = {}
+    for i in range(sections):
+        section = {}
+        for j in range(leaves):
+            section['key{}'.format(j)] = [j, 'value {}'.format(j), j * 1.5, j % 2 == 0][j % 4]
+        section['list'] = [{'name': 'item{}'.format(j), 'port': 8000 + j} for j in range(5)]
+        doc['section{}'.format(i)] = section
+    return doc
+
+
+_tmp = []
+
+
+def write_temp(name, text):
+    """
+    Write a file in a temporary directory that's removed at exit.
+    """
+    if not _tmp:
+        _tmp.append(tempfile.mkdtemp(prefix='scruffy-bench-'))
+        atexit.register(shutil.rmtree, _tmp[0], True)
+    path = os.path.join(_tmp[0], name)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+@bench('read, shallow key path')
+def read_shallow():
+    c = Config(data={'a': 1})
+    return lambda: c['a']
+
+
+@bench('read, deep key path (8 levels)')
+def read_deep_key_path():
+    c = Config(data=nested(8, width=2))
+    key = '.'.join(['k1'] * 8)
+    return lambda: c[key]
+
+
+@bench('read, deep attributes (8 levels)')
+def read_deep_attr():
+    c = Config(data=nested(8, width=2))
+    return lambda: c.k1.k1.k1.k1.k1.k1.k1.k1
+
+
+@bench('read, list index in key path')
+def read_list_index():
+    c = Config(data={'servers': [{'port': i} for i in range(10)]})
+    return lambda: c['servers.5.port']
+
+
+@bench('read, frozen deep key path (8 levels)')
+def read_frozen_deep_key_path():
+    c = Config(data=nested(8, width=2)).freeze()
+    key = '.'.join(['k1'] * 8)
+    return lambda: c[key]
+
+
+@bench('read, frozen deep attributes (8 levels)')
+def read_frozen_deep_attr():
+    c = Config(data=nested(8, width=2)).freeze()
+    return lambda: c.k1.k1.k1.k1.k1.k1.k1.k1
+
+
+@bench('construct, 5**6 leaf defaults with a small overlay', number=20)
+def construct_large_defaults():
+    defaults = nested(6)
+    data = {'k1': {'k2': {'k3': 2}}}
+    return lambda: Config(data=data, defaults=defaults)
+
+
+@bench('parse, 200 sections as JSON (json)', number=3)
+def parse_json():
+    text = json.dumps(document(200), indent=4)
+    return lambda: parse(text, '.json')
+
+
+# PyYAML is sometimes built without libyaml
+if hasattr(yaml, 'CSafeLoader'):
+    @bench('parse, 200 sections as YAML (libyaml)', number=3)
+    def parse_yaml_c():
+        text = yaml.safe_dump(document(200), default_flow_style=False)
+        return lambda: yaml.load(text, Loader=yaml.CSafeLoader)
+
+
+@bench('parse, 200 sections as YAML (pure python)', number=3)
+def parse_yaml_py():
+    text = yaml.safe_dump(document(200), default_flow_style=False)
+    return lambda: yaml.load(text, Loader=yaml.SafeLoader)
+
+
+def load_file(ext, sections):
+    """
+    Return a benchmark setup function for loading a ConfigFile with the given
+    extension and number of sections.
+    """
+    def setup():
+        doc = document(sections)
+        if ext == '.json':
+            text = json.dumps(doc, indent=4)
+        else:
+            text = yaml.safe_dump(doc, default_flow_style=False)
+        path = write_temp('config-{}{}'.format(sections, ext), text)
+        return lambda: ConfigFile(path).load()
+    return setup
+
+
+for sections, number in ((20, 30), (200, 3), (2000, 1)):
+    for ext in ('.json', '.yaml'):
+        bench('ConfigFile.load, {} sections in a {} file'.format(sections, ext), number=number)(
+            load_file(ext, sections))
+
+
+@bench('ConfigFile.load, 200 sections in a .yaml file, cached', number=3)
+def load_yaml_cached():
+    path = write_temp('config.yaml', yaml.safe_dump(document(200), default_flow_style=False))
+    cache = os.path.join(_tmp[0], 'cache')
+    ConfigFile(path, cache=cache).load()
+    return lambda: ConfigFile(path, cache=cache).load()
+
+
+@bench('ConfigEnv, 200 overrides in a 5000 variable environment', number=20)
+def config_env():
+    names = []
+    for i in range(4800):
+        names.append('SCRUFFY_BENCH_OTHER_{}'.format(i)[8:])
+    for i in range(200):
+        names.append('SCRUFFY_BENCH.SECTION{}.KEY{}'.format(i % 10, i))
+    env = dict((name, str(i)) for i, name in enumerate(names))
+    os.environ.update(env)
+    atexit.register(lambda: [os.environ.pop(name, None) for name in env])
+    defaults = {'bench': dict(('section{}'.format(i), {}) for i in range(10))}
+    return lambda: ConfigEnv(defaults=defaults)
+
+
+@bench('ConfigApplicator.apply_to_str, 3 variables')
+def apply_to_str():
+    ap = ConfigApplicator(Config(data={'base': '/srv', 'app': {'name': 'x', 'env': 'prod'}}))
+    return lambda: ap.apply_to_str('{config:base}/{config:app.name}/{config:app.env}/log.txt')
+
+
+@bench('ConfigApplicator, tree of 2000 templated paths', number=5)
+def apply_tree():
+    config = Config(data={'base': '/srv', 'app': {'name': 'x', 'env': 'prod'}})
+    templates = ['{{config:base}}/{{config:app.name}}/{{config:app.env}}/{}/file{}.txt'.format(i % 20, i)
+                 for i in range(2000)]
+
+    def run():
+        d = Directory('{config:base}', **dict(('f{}'.format(i), File(t)) for i, t in enumerate(templates)))
+        d.apply_config(ConfigApplicator(config))
+    return run
+
+
+def overlays(count=10, sections=50, keys=1000):
+    """
+    Build a 50k-key tree and `count` overlays that each change a few keys in
+    a few sections.
+    """
+    tree = dict(('s{}'.format(i), dict(('k{}'.format(j), j) for j in range(keys))) for i in range(sections))
+    return tree, [dict(('s{}'.format((n * 7 + i) % sections), dict(('k{}'.format(j * 13 % keys), n) for j in range(10)))
+                       for i in range(10)) for n in range(count)]
+
+
+@bench('update_dict, 10 overlays onto a 50k-key tree', number=100)
+def bench_update_dict():
+    tree, layers = overlays()
+
+    def run():
+        for layer in layers:
+            update_dict(tree, layer)
+    return run
+
+
+@bench('merge_dicts, 10 overlays onto a 50k-key tree', number=100)
+def bench_merge_dicts():
+    tree, layers = overlays()
+    return lambda: merge_dicts(tree, layers)
+
+
+@bench('Config.update, 10 overlays onto 50k-key defaults', number=100)
+def bench_config_update():
+    tree, layers = overlays()
+
+    def run():
+        c = Config(defaults=tree)
+        for layer in layers:
+            c.update(layer)
+    return run
+
+
+def typed(sections=100, keys=100):
+    """
+    Build a tree with `sections` sections of `keys` keys, and a schema for it.
+    """
+    types = [int, str, float, bool]
+    values = [1, 'x', 1.5, True]
+    tree = dict(('s{}'.format(i), dict(('k{}'.format(j), values[j % 4]) for j in range(keys)))
+                for i in range(sections))
+    spec = dict(('s{}'.format(i), dict(('k{}'.format(j), Field(types[j % 4], required=True))
+                                       for j in range(keys)))
+                for i in range(sections))
+    return tree, spec
+
+
+@bench('Schema.check, 10k keys', number=20)
+def bench_schema_check():
+    tree, spec = typed()
+    schema = Schema(spec)
+    return lambda: schema.check(tree)
+
+
+@bench('Config.validate, 10k keys with 250 conversions', number=20)
+def bench_config_validate():
+    tree, spec = typed()
+    for i in range(10):
+        for j in range(0, 100, 4):
+            tree['s{}'.format(i)]['k{}'.format(j)] = str(j)
+    schema = Schema(spec)
+    return lambda: Config(defaults=tree).validate(schema)
+
+
+@bench('Config.diff, 50k-key tree against a copy with 10 overlays', number=100)
+def bench_config_diff():
+    tree, layers = overlays()
+    a = Config(defaults=tree)
+    b = Config(defaults=tree)
+    for layer in layers:
+        b.update(layer)
+    return lambda: a.diff(b)
+
+
+@bench('ConfigNode.fingerprint, 50k keys, cold', number=10)
+def bench_fingerprint_cold():
+    tree, layers = overlays()
+    c = Config(defaults=tree)
+
+    def run():
+        c._hashes = [None, {}]
+        c.fingerprint()
+    return run
+
+
+@bench('ConfigNode.fingerprint, 50k keys, after one write')
+def bench_fingerprint_write():
+    tree, layers = overlays()
+    c = Config(defaults=tree)
+    c.fingerprint()
+
+    def run():
+        c['s0.k0'] = 1
+        c.fingerprint()
+    return run
+
+
+
+def conf_d(count=200):
+    """
+    Write `count` YAML fragments into a temporary conf.d directory and return
+    its path.
+    """
+    path = os.path.join(os.path.dirname(write_temp('.keep', '')), 'conf.d')
+    if not os.path.exists(path):
+        os.mkdir(path)
+        for i in range(count):
+            with open(os.path.join(path, '{:03}.yaml'.format(i)), 'w') as f:
+                f.write(yaml.dump({'section{}'.format(i): document(1)['section0']}, default_flow_style=False))
+    return path
+
+
+@bench('ConfigDirectory.load, 200 YAML fragments, serial', number=3)
+def load_conf_d_serial():
+    path = conf_d()
+    return lambda: ConfigDirectory(path, workers=1).load()
+
+
+@bench('ConfigDirectory.load, 200 YAML fragments, one thread per CPU', number=3)
+def load_conf_d_pool():
+    path = conf_d()
+    return lambda: ConfigDirectory(path).load()
+
+
+def large_document(sections=20, entries=5000):
+    """
+    Write a YAML file with a few large lookup tables and a small settings
+    section.
+    """
+    doc = dict(('table{}'.format(i), dict(('key{}'.format(j), 'value {}'.format(j)) for j in range(entries)))
+               for i in range(sections))
+    doc['settings'] = {'port': 8080}
+    return write_temp('large.yaml', yaml.dump(doc, default_flow_style=False))
+
+
+@bench('ConfigFile.load of 100k-entry YAML, read one key, eager', number=1)
+def load_large_yaml_eager():
+    path = large_document()
+    return lambda: ConfigFile(path, load=True).settings.port
+
+
+@bench('ConfigFile.load of 100k-entry YAML, read one key, lazy', number=1)
+def load_large_yaml_lazy():
+    path = large_document()
+    return lambda: ConfigFile(path, load=True, lazy=True).settings.port
+
+
+@bench('Config.load_snapshot, 200 sections, read one key', number=100)
+def load_snapshot_one():
+    path = os.path.join(os.path.dirname(write_temp('.keep', '')), 'config.snap')
+    Config(defaults=document(200)).dump_snapshot(path)
+    return lambda: Config.load_snapshot(path).section0.key1
+
+
+@bench('Config.load_snapshot, 200 sections, read everything', number=20)
+def load_snapshot_all():
+    path = os.path.join(os.path.dirname(write_temp('.keep', '')), 'config.snap')
+    Config(defaults=document(200)).dump_snapshot(path)
+    return lambda: Config.load_snapshot(path).to_dict()
+
+
+@bench('Config.attach_snapshot, 200 sections in shared memory, read one key', number=100)
+def attach_snapshot_one():
+    shm = Config(defaults=document(200)).share_snapshot()
+    atexit.register(shm.unlink)
+    atexit.register(shm.close)
+    return lambda: Config.attach_snapshot(shm.name).section0.key1
+
+
+def read_write(threadsafe, readers=4, reads=5000, writes=500):
+    """
+    Return a function that runs `readers` threads doing deep reads while the
+    calling thread makes changes.
+    """
+    c = Config(defaults=overlays()[0], threadsafe=threadsafe)
+
+    def read():
+        for i in range(reads):
+            c['s1.k1']
+            c.s2.k2
+
+    def run():
+        threads = [threading.Thread(target=read) for i in range(readers)]
+        for t in threads:
+            t.start()
+        for i in range(writes):
+            c['s{}.k{}'.format(i % 50, i)] = i
+        for t in threads:
+            t.join()
+    return run
+
+
+@bench('4 reader threads, 40k reads, 500 writes', number=3)
+def read_write_default():
+    return read_write(False)
+
+
+@bench('4 reader threads, 40k reads, 500 writes, threadsafe', number=3)
+def read_write_threadsafe():
+    return read_write(True)
+
+
+@bench('read, deep key path (8 levels), profiled')
+def read_deep_key_path_profiled():
+    c = Config(data=nested(8, width=2))
+    c.start_profiling()
+    key = '.'.join(['k1'] * 8)
+    return lambda: c[key]
+
+
+def clusters(count=500, nodes=20):
+    return Config(defaults={'clusters': dict(('cluster{}'.format(i), {
+        'nodes': [{'host': 'node{}'.format(j), 'port': 8000 + j} for j in range(nodes)],
+    }) for i in range(count))})
+
+
+@bench('walk 500 clusters x 20 nodes for ports through items()', number=5)
+def walk_ports():
+    c = clusters()
+    def run():
+        ports = []
+        for name, cluster in c.clusters.items():
+            nodes = c.clusters[name].nodes
+            for i in range(len(cluster['nodes'])):
+                ports.append(('clusters.{}.nodes.{}.port'.format(name, i), nodes[i].port))
+        return ports
+    return run
+
+
+@bench('ConfigNode.query, 500 clusters x 20 nodes, cold', number=5)
+def query_ports_cold():
+    c = clusters()
+
+    def run():
+        c.clusters.cluster0.nodes[0].port = 8000
+        return c.query('clusters.*.nodes.*.port')
+    return run
+
+
+@bench('ConfigNode.query, 500 clusters x 20 nodes, cached')
+def query_ports_cached():
+    c = clusters()
+    return lambda: c.query('clusters.*.nodes.*.port')
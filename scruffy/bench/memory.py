@@ -0,0 +1,62 @@
+"""
+Memory benchmarks for the config subsystem.
+
+Each benchmark returns the number of bytes still allocated by the config it
+builds, as measured by tracemalloc.
+"""
+import gc
+import json
+import tracemalloc
+
+from functools import partial
+
+from . import benchmark
+from .config import write_temp
+from ..config import ConfigFile
+
+BENCHMARKS = []
+UNIT = 'bytes'
+bench = partial(benchmark, BENCHMARKS)
+
+
+def records(sections=20, count=500):
+    """
+    Build a config with a few big sections full of similar records.
+    """
+    return dict(('cluster{}'.format(i), {
+        'nodes': [{'name': 'node-{}-{}'.format(i, j), 'port': 8000 + j % 10, 'enabled': True, 'weight': 1.0,
+                   'tags': ['web', 'prod'], 'limits': {'cpu': 2, 'memory': '4G'}} for j in range(count)],
+        'settings': {'timeout': 30, 'retries': 3},
+    }) for i in range(sections))
+
+
+def measure(build):
+    """
+    Return the number of bytes allocated by `build()` that are still in use
+    while its result is alive.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def load(compact):
+    path = write_temp('records.json', json.dumps(records()))
+    return lambda: measure(lambda: ConfigFile(path, compact=compact).load())
+
+
+@bench('ConfigFile.load, 10k records in a .json file')
+def load_plain():
+    return load(False)
+
+
+@bench('ConfigFile.load, 10k records in a .json file, compact')
+def load_compact():
+    return load(True)
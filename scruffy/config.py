@@ -8,12 +8,60 @@ from six import string_types
 
 import copy
 import os
+import fnmatch
 import ast
 import yaml
 import re
-
-from six import string_types
-from .file import File
+import hashlib
+import pickle
+import logging
+import threading
+import multiprocessing
+import json
+import time
+import timeit
+
+from collections import OrderedDict
+from six import string_types, integer_types, text_type, binary_type
+from six.moves import intern
+from six.moves.http_client import HTTPException
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import Request, urlopen
+from .file import File, Directory, LazyDocument, SafeDumper, parse
+from .schema import Schema, coerce
+from . import snapshot
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    HAVE_FUTURES = True
+except ImportError:
+    HAVE_FUTURES = False
+
+log = logging.getLogger(__name__)
+
+# Maximum number of compiled key paths cached per config root. When the cache
+# fills up it is simply cleared, which keeps it bounded without the bookkeeping
+# of an LRU.
+PATH_CACHE_SIZE = 4096
+
+# Types of values that are returned wrapped in a ConfigNode rather than as-is
+NODE_TYPES = frozenset([dict, list, type(None)])
+
+# Types of values that can't be modified, so they're never copied
+SCALAR_TYPES = frozenset([type(None), bool, float, complex, text_type, binary_type] + list(integer_types))
+
+# Names of the layers that make up a config, from lowest to highest priority.
+# Changes made at runtime sit on top of these.
+LAYERS = ('defaults', 'file', 'env')
+
+# Strategies for merging a value into one that's already there (see
+# update_dict). By default dicts are merged and anything else is replaced.
+REPLACE = 'replace'         # replace the existing value, even if it's a dict
+APPEND = 'append'           # append to the existing list
+MERGE = 'merge'             # merge into the existing dict
+KEEP_FIRST = 'keep-first'   # keep the existing value
+STRATEGIES = (REPLACE, APPEND, MERGE, KEEP_FIRST)
 
 
 class ConfigNode(object):
@@ -31,28 +79,113 @@ class ConfigNode(object):
     Or as an object, like this:
 
         >>> config.top_level_section.second_level_property
+
+    Nodes below the root are lightweight views that hold only a reference to
+    the root node and their key path, so walking down the tree doesn't copy
+    or merge anything.
+
+    The root node's data is built from a stack of layers (see `LAYERS`), with
+    any changes made at runtime on top. The layers are never modified, and
+    the merged tree shares any subtrees that are only defined in one layer
+    with that layer. Shared containers are copied the first time they're
+    written to.
+
+    If `interpolate` is set, values can refer to other values in the config
+    with the same `{config:...}` syntax as ConfigApplicator, like this:
+
+        paths:
+            base: /srv/thing
+            log: "{config:paths.base}/log"
+
+    References are resolved once when the config is built, and only resolved
+    again when a value they depend on is changed. A value that consists of a
+    single reference keeps the type of the value it refers to.
+
+    `strategies` is a dict of key paths and merge strategies (see update_dict)
+    used whenever layers or updates are merged into the config.
+
+    If `schema` is given (either a Schema or a spec to create one from), the
+    config is validated against it whenever it's built, with defaults filled
+    in and values converted to the right types. Changes made at runtime
+    aren't validated until `validate()` is called.
+
+    Changes are made one at a time under a lock. If `threadsafe` is set, they
+    are also made read-copy-update style: the containers on the path down to
+    the change are copied, the change is made to the copies, and the new tree
+    is swapped in as a whole. Readers never take the lock, and always see a
+    consistent tree as long as they get everything they need from a single
+    value (e.g. `config.server.to_dict()` rather than `config.server.host`
+    followed by `config.server.port`).
+
+    If `compact` is set, each layer is compacted (see `compact()`) when it's
+    added, which can save a lot of memory for large configs with many
+    repeated keys and values.
     """
-    def __init__(self, data={}, defaults={}, root=None, path=None):
+    # __weakref__ is here rather than added by subclasses so they all have the
+    # same layout, which lets start_profiling() swap a root node's class
+    __slots__ = ('_root', '_path', '__dict__', '__weakref__')
+
+    def __init__(self, data={}, defaults={}, root=None, path=None, interpolate=False, strategies=None,
+                 schema=None, threadsafe=False, compact=False):
         super(ConfigNode, self).__init__()
+        if root is None:
+            root = self
+            self._paths = {}
+            self._subscribers = {}
+            self._interpolate = interpolate
+            self._strategies = compile_strategies(strategies)
+            if schema is not None and not isinstance(schema, Schema):
+                schema = Schema(schema)
+            self._schema = schema
+            self._templates = {}
+            self._hashes = [None, {}]
+            self._pending = set()
+            self._threadsafe = threadsafe
+            self._compact = compact
+            self._compacted = set()
+            self._lock = threading.RLock()
+            self._dirty = False
+            self._data = None
+            self._owned = {}
+            self._owned_live = 0
+            self._version = 0
+            self._query_results = {}
+            self._profile = None
+            self._layers = {'defaults': defaults}
+            self._overrides = OrderedDict()
+            self._rebuild()
         self._root = root
-        if not self._root:
-            self._root = self
+        if path is None:
+            path = ()
+        elif not isinstance(path, tuple):
+            path = root._compile(path)
         self._path = path
-        self._defaults = defaults
-        self._data = copy.deepcopy(self._defaults)
         self.update(data)
 
+    @classmethod
+    def _view(cls, root, path):
+        """
+        Create a node for the given root and compiled key path without going
+        through __init__.
+        """
+        node = object.__new__(cls)
+        _set_root(node, root)
+        _set_path(node, path)
+        return node
+
     def __getitem__(self, key):
         c = self._child(key)
         v = c._get_value()
-        if type(v) in [dict, list, type(None)]:
+        if type(v) in NODE_TYPES:
             return c
         else:
             return v
 
     def __setitem__(self, key, value):
-        container, last = self._child(key)._resolve_path(create=True)
-        container[last] = value
+        self._root._override('_set', self._path + self._compile(key), value)
+
+    def __delitem__(self, key):
+        self._root._override('_delete', self._path + self._compile(key))
 
     def __getattr__(self, key):
         return self[key]
@@ -116,90 +249,510 @@ class ConfigNode(object):
         Return a ConfigNode object representing a child node with the specified
         relative path.
         """
-        if self._path:
-            path = '{}.{}'.format(self._path, path)
-        return ConfigNode(root=self._root, path=path)
+        return ConfigNode._view(self._root, self._path + self._compile(path))
 
-    def _resolve_path(self, create=False):
+    def _compile(self, path):
         """
-        Returns a tuple of a reference to the last container in the path, and
-        the last component in the key path.
+        Compile a relative key path into a tuple of keys (see compile_path).
 
-        For example, with a self._value like this:
+        Compiled paths are cached on the root node, so each path string is
+        only parsed once for all of the nodes under that root.
+        """
+        if not isinstance(path, string_types):
+            return (path,)
+        cache = self._root._paths
+        try:
+            return cache[path]
+        except KeyError:
+            pass
+        if len(cache) >= PATH_CACHE_SIZE:
+            cache.clear()
+        keys = cache[path] = compile_path(path)
+        return keys
 
-        {
-            'thing': {
-                'another': {
-                    'some_leaf': 5,
-                    'one_more': {
-                        'other_leaf': 'x'
-                    }
-                }
-            }
-        }
+    def _rebuild(self):
+        """
+        Rebuild the root node's data by merging its layers, then replaying any
+        changes that were made at runtime.
+        """
+        with self._lock:
+            # build the new tree to one side and swap it in at the end, so readers
+            # never see it half built
+            old = self._data
+            # if the new tree can't be built, e.g. because it fails validation,
+            # everything is left as it was
+            saved = (self._owned, self._templates, self._overrides.copy())
+            try:
+                self._owned = {}
+                data = self._own({})
+
+                if self._compact:
+                    for name in LAYERS:
+                        layer = self._layers.get(name)
+                        if type(layer) == dict and id(layer) not in self._compacted:
+                            self._layers[name] = compact(layer)
+                    self._compacted = set(id(layer) for layer in self._layers.values())
+
+                # sections of lazily loaded layers are left out until they're read
+                pending = set()
+                for name in LAYERS:
+                    layer = self._layers.get(name)
+                    if isinstance(layer, LazyDocument):
+                        if self._interpolate or self._schema is not None:
+                            # these need the whole tree anyway
+                            self._layers[name] = layer.load()
+                        else:
+                            pending.update(layer)
+
+                for name in LAYERS:
+                    layer = self._layers.get(name)
+                    if pending and layer:
+                        if isinstance(layer, LazyDocument):
+                            continue
+                        layer = dict((k, v) for k, v in layer.items() if k not in pending)
+                    if layer:
+                        self._merge(data, (), layer)
+                for key, (op, path, args) in list(self._overrides.items()):
+                    try:
+                        if pending:
+                            if path[:1] and path[0] in pending:
+                                continue
+                            if not path:
+                                args = (dict((k, v) for k, v in args[0].items() if k not in pending),) + args[1:]
+                        getattr(self, op)(data, path, *args)
+                    except (KeyError, IndexError, TypeError):
+                        # the layers underneath have changed such that this no longer
+                        # applies, so forget about it
+                        del self._overrides[key]
+                if self._interpolate:
+                    self._templates = {}
+                    self._resolve_templates(data, [()])
+                if self._schema is not None:
+                    for path, value in self._schema.check(data):
+                        self._set(data, path, value)
+            except Exception:
+                self._owned, self._templates, self._overrides = saved
+                raise
+            self._data = data
+            self._version += 1
+            self._hashes = [None, {}]
+            self._pending = pending
+
+        if old is not None and self._subscribers:
+            self._load_sections(p[0] for p in self._subscribers if p)
+            self._notify([(path, _lookup(old, path)) for path in self._subscribers])
+
+    def _set_layer(self, name, data):
+        """
+        Replace one of the root node's layers and rebuild its data. If the
+        rebuild fails the old layer is put back.
+        """
+        old = self._layers.get(name)
+        self._layers[name] = data
+        try:
+            self._rebuild()
+        except Exception:
+            if old is None:
+                del self._layers[name]
+            else:
+                self._layers[name] = old
+            raise
+
+    def _override(self, op, path, *args):
+        """
+        Make a change to the root node's data at runtime, and record it so it
+        can be replayed if the layers underneath are replaced.
+
+        `op` is the name of the method that applies the change - '_set',
+        '_delete' or '_merge' - and `args` are passed to it after the key path.
+        """
+        with self._lock:
+            if self._pending:
+                self._load_sections(path[:1] if path else list(args[0]))
+                self._load_sections(p[0] for p in self._subscribers if p)
+
+            # keep a copy of the old value at any subscribed paths this affects
+            changed = None
+            if self._subscribers:
+                changed = [(p, copy.deepcopy(_lookup(self._data, p))) for p in self._subscribers
+                           if p[:len(path)] == path or path[:len(p)] == p]
+
+            # with interpolation a change can fail after it's been made (e.g. if
+            # it refers to a value that doesn't exist), so it's made to a copy
+            # of the tree and the old one is kept if it does
+            saved = (self._owned, self._templates)
+            data = self._begin_write(self._interpolate)
+            try:
+                if self._interpolate:
+                    self._templates = dict(self._templates)
+                getattr(self, op)(data, path, *args)
+                if self._interpolate:
+                    self._resolve_templates(data, [path], op == '_merge')
+            except Exception:
+                self._owned, self._templates = saved
+                raise
+            self._data = data
+            self._version += 1
+            self._dirty = True
+            if op != '_merge':
+                # a later set of the same path supersedes an earlier one, as
+                # does a later delete (a set also creates the dicts above it,
+                # so a delete doesn't supersede one)
+                key = (op, path)
+                self._overrides.pop(key, None)
+            else:
+                # merges are cumulative, so each one gets a unique key, but any
+                # earlier changes this one overwrites entirely are forgotten
+                self._supersede(path, *args)
+                key = object()
+            self._overrides[key] = (op, path, args)
+            if len(self._owned) > 2 * self._owned_live + 100:
+                self._prune_owned()
+
+        if changed:
+            self._notify(changed)
+
+    def _supersede(self, path, source, strategies=None):
+        """
+        Forget any changes made at runtime that merging `source` at a key
+        path will overwrite entirely, so that updating the same keys over and
+        over doesn't keep adding to the changes replayed on every rebuild.
+
+        A change is only forgotten if every value it wrote is replaced, by
+        this merge or by a set made since, nothing it wrote is on the way down
+        to the key paths they write to, and nothing else changed since then is
+        at, above or below any of the keys it wrote. Replaying what's left
+        gives the same result.
+        """
+        if self._strategies and strategies:
+            strategies = dict(list(self._strategies.items()) + list(strategies.items()))
+        strategies = strategies or self._strategies or {}
+
+        # the key paths whose values are replaced, whatever they were
+        replaced = set()
+        stack = [(path, source)]
+        while stack:
+            parent, value = stack.pop()
+            for k, v in value.items():
+                key_path = parent + (k,)
+                strategy = strategies.get(key_path)
+                if strategy in (KEEP_FIRST, APPEND):
+                    continue
+                if isinstance(v, dict) and strategy != REPLACE:
+                    stack.append((key_path, v))
+                else:
+                    replaced.add(key_path)
+        if not replaced:
+            return
+        # the dicts walked through to get to them, which have to already be
+        # there or are created empty
+        walked = set(path[:i] for i in range(1, len(path) + 1))
+
+        # only merges into the same top-level sections can be forgotten
+        tops = set(r[0] for r in replaced)
+        overrides = list(self._overrides.items())
+        candidates = set(i for i, (key, (op, p, args)) in enumerate(overrides)
+                         if op == '_merge' and (p[0] in tops if p else not tops.isdisjoint(args[0])))
+        if not candidates:
+            return
+        first = min(candidates)
+
+        # key paths written by the other changes kept so far, and all their
+        # prefixes
+        written_since = set()
+        prefixes_since = set()
+        for i in range(len(overrides) - 1, first - 1, -1):
+            key, (op, p, args) = overrides[i]
+            if i in candidates:
+                for w, leaf in _written_paths(op, p, args):
+                    if (w in walked or w in prefixes_since or
+                            any(w[:j] in written_since for j in range(1, len(w))) or
+                            leaf and not any(w[:j] in replaced for j in range(1, len(w) + 1))):
+                        break
+                else:
+                    del self._overrides[key]
+                    continue
+            if i == first:
+                break
+            if op == '_set':
+                replaced.add(p)
+                walked.update(p[:j] for j in range(1, len(p)))
+            else:
+                written = [w for w, leaf in _written_paths(op, p, args)]
+                written_since.update(written)
+                prefixes_since.update(w[:j] for w in written for j in range(1, len(w) + 1))
+
+    def _prune_owned(self):
+        """
+        Forget the containers the root node's data has owned that have since
+        been replaced or deleted, so they can be garbage collected.
+        """
+        owned = {}
+        stack = [self._data]
+        while stack:
+            node = stack.pop()
+            owned[id(node)] = node
+            children = node.values() if type(node) == dict else node
+            stack.extend(v for v in children if type(v) in (dict, list) and id(v) in self._owned)
+        self._owned = owned
+        self._owned_live = len(owned)
+
+    def _begin_write(self, isolated=False):
+        """
+        Return the tree that a change should be made to, and then swapped in
+        as the root node's data.
 
-        And a self._path of: 'thing.another.some_leaf'
+        This is the current tree, unless the root is threadsafe or `isolated`
+        is set, in which case it's a copy of the top-level dict with none of
+        the containers under it owned, so everything on the way down to the
+        change gets copied and the current tree is never modified.
+        """
+        if not self._threadsafe and not isolated:
+            return self._data
+        self._owned = {}
+        return self._own(copy.copy(self._data))
 
-        This will return a tuple of a reference to the 'another' dict, and
-        'some_leaf', allowing the setter and casting methods to directly access
-        the item referred to by the key path.
+    def _load_sections(self, keys):
         """
-        # Split up the key path
-        if isinstance(self._path, string_types):
-            key_path = self._path.split('.')
-        else:
-            key_path = [self._path]
+        Build any of the given top-level sections that haven't been built yet
+        because they're in a lazily loaded layer.
 
-        # Start at the root node
-        node = self._root._data
-        nodes = [self._root._data]
+        Each section is merged from the layers on its own, then any changes
+        made at runtime that affect it are replayed.
+        """
+        keys = [k for k in keys if k in self._pending]
+        if not keys:
+            return
+        with self._lock:
+            for key in keys:
+                if key not in self._pending:
+                    continue
+                section = self._own({})
+                for name in LAYERS:
+                    layer = self._layers.get(name)
+                    if layer and key in layer:
+                        self._merge(section, (), {key: layer[key]})
+                for k, (op, path, args) in list(self._overrides.items()):
+                    try:
+                        if path[:1] == (key,):
+                            getattr(self, op)(section, path, *args)
+                        elif not path and key in args[0]:
+                            self._merge(section, (), {key: args[0][key]}, *args[1:])
+                    except (KeyError, IndexError, TypeError):
+                        del self._overrides[k]
+                # make the section visible before it stops being pending, so
+                # readers always find it in one or the other
+                if key in section:
+                    if self._threadsafe:
+                        data = copy.copy(self._data)
+                        data[key] = section[key]
+                        self._data = data
+                    else:
+                        self._data[key] = section[key]
+                    self._version += 1
+                self._pending.discard(key)
+
+    def _notify(self, old):
+        """
+        Call the callbacks subscribed to any of the key paths in `old`, a list
+        of (path, old value) tuples, whose value has changed.
+        """
+        for path, old_value in old:
+            new_value = _lookup(self._data, path)
+            if new_value is not old_value and new_value != old_value:
+                for key, callback in list(self._subscribers.get(path, ())):
+                    callback(key, old_value, new_value)
 
-        # Traverse along key path
-        while len(key_path):
-            # Get the next key in the key path
-            key = key_path.pop(0)
+    def _resolve_templates(self, data, written, merged=False):
+        """
+        Find any values containing config variables at or under the `written`
+        key paths, and resolve them along with any values that depend on the
+        values that were written.
 
-            # See if the test could be an int for array access, if so assume it is
-            try:
-                key = int(key)
-            except:
-                pass
-
-            # If the next level doesn't exist, create it
-            if create:
-                if type(node) == dict and key not in node:
-                    node[key] = {}
-                elif type(node) == list and type(key) == int and len(node) < key:
-                    node.append([None for i in range(key-len(node))])
-
-            # Store the last node and traverse down the hierarchy
-            nodes.append(node)
-            try:
-                node = node[key]
-            except TypeError:
-                if type(key) == int:
-                    raise IndexError(key)
+        If `merged` is set, the values were merged in rather than replaced,
+        so values under them that still hold what was resolved are kept.
+        """
+        templates = self._templates
+
+        # forget about any values that have been overwritten, and find any new
+        # ones containing variables
+        for path in written:
+            for t in [t for t in templates if t[:len(path)] == path]:
+                if not merged or _lookup(data, t) is not templates[t][3]:
+                    del templates[t]
+            for t, raw in _find_templates(_lookup(data, path), path):
+                template = compile_template(raw)
+                deps = [compile_path(tok) for op, tok in template if op == TEMPLATE_VAR]
+                templates[t] = (raw, template, deps, None)
+
+        # work out which values are affected by the change - anything that was
+        # written, and anything that depends on something that was affected
+        affected = set()
+        changed = list(written)
+        while changed:
+            path = changed.pop()
+            for t, (raw, template, deps, value) in templates.items():
+                if t not in affected and (_overlaps(t, path) or any(_overlaps(d, path) for d in deps)):
+                    affected.add(t)
+                    changed.append(t)
+
+        # resolve them, dependencies first
+        resolving = []
+        resolved = set()
+
+        def resolve(t):
+            if t in resolved:
+                return
+            if t in resolving:
+                cycle = resolving[resolving.index(t):] + [t]
+                raise ValueError("Circular config reference: {}".format(
+                    ' -> '.join('.'.join(str(k) for k in p) for p in cycle)))
+            resolving.append(t)
+            raw, template, deps, value = templates[t]
+            for d in deps:
+                for u in affected:
+                    if _overlaps(u, d):
+                        resolve(u)
+            toks = []
+            for op, tok in template:
+                if op == TEMPLATE_TEXT:
+                    toks.append(tok)
+                elif op == TEMPLATE_VAR:
+                    val = _lookup(data, compile_path(tok))
+                    if val is None:
+                        raise KeyError("No such config variable '{}'".format(tok))
+                    toks.append(val)
                 else:
-                    raise KeyError(key)
+                    toks = [raw]
+                    break
+            if len(toks) == 1:
+                # a section or list is copied, so writing to one copy of it
+                # doesn't change the other
+                value = _copy_tree(toks[0])
+            else:
+                value = ''.join(str(tok) for tok in toks)
+            self._set(data, t, value)
+            templates[t] = (raw, template, deps, value)
+            resolving.pop()
+            resolved.add(t)
+
+        for t in affected:
+            resolve(t)
+
+    def _own(self, container):
+        """
+        Mark a container as belonging to this root's merged data, so it can
+        be modified in place.
+        """
+        self._owned[id(container)] = container
+        return container
+
+    def _writable(self, parent, key, create=False):
+        """
+        Return the container at `parent[key]`, copying it first if it is
+        shared with one of the layers or with data passed in at runtime.
+
+        If `create` is set, a new dict is created if the key doesn't exist.
+        """
+        if create:
+            if type(parent) == dict and key not in parent:
+                parent[key] = self._own({})
+            elif type(parent) == list and type(key) == int and len(parent) < key:
+                parent.append([None for i in range(key-len(parent))])
+        try:
+            node = parent[key]
+        except TypeError:
+            if type(key) == int:
+                raise IndexError(key)
+            else:
+                raise KeyError(key)
+        if id(node) not in self._owned and type(node) in (dict, list):
+            node = parent[key] = self._own(copy.copy(node))
+        return node
+
+    def _invalidate(self, path):
+        """
+        Forget the fingerprints of the value at a key path, everything under
+        it, and the sections above it.
+        """
+        node = self._hashes
+        node[0] = None
+        for key in path[:-1]:
+            node = node[1].get(key)
+            if node is None:
+                return
+            node[0] = None
+        if path:
+            node[1].pop(path[-1], None)
+        else:
+            node[1].clear()
+
+    def _set(self, data, path, value):
+        """
+        Set the value at a key path in the root node's data.
+        """
+        self._invalidate(path)
+        node = data
+        for key in path[:-1]:
+            node = self._writable(node, key, create=True)
+        try:
+            node[path[-1]] = value
+        except TypeError:
+            if type(path[-1]) == int:
+                raise IndexError(path[-1])
+            else:
+                raise KeyError(path[-1])
+
+    def _delete(self, data, path):
+        """
+        Delete the value at a key path in the root node's data.
+        """
+        if not path:
+            raise KeyError(path)
+        # deleting from a list moves everything after it, so forget the lot
+        self._invalidate(path[:-1])
+        node = data
+        for key in path[:-1]:
+            node = self._writable(node, key)
+        try:
+            del node[path[-1]]
+        except TypeError:
+            raise KeyError(path[-1])
 
-        return (nodes[-1], key)
+    def _merge(self, data, path, source, strategies=None):
+        """
+        Merge a nested dict into the root node's data at a key path.
+
+        `strategies` are compiled merge strategies to use on top of the root
+        node's own.
+        """
+        self._invalidate(path)
+        node = data
+        for key in path:
+            node = self._writable(node, key, create=True)
+        if self._strategies and strategies:
+            strategies = dict(list(self._strategies.items()) + list(strategies.items()))
+        _merge_tree(node, source, strategies or self._strategies, self._writable, path)
 
     def _get_value(self):
         """
         Get the value represented by this node.
         """
-        if self._path:
+        root = self._root
+        node = root._data
+        if not self._path and root._pending:
+            root._load_sections(list(root._pending))
+        for key in self._path:
             try:
-                container, last = self._resolve_path()
-                return container[last]
-            except KeyError:
-                return None
-            except IndexError:
-                return None
-        else:
-            return self._data
-
-    def update(self, data={}, options={}):
+                node = node[key]
+            except (KeyError, IndexError, TypeError):
+                if node is not root._data or key not in root._pending:
+                    return None
+                root._load_sections([key])
+                node = root._data.get(key)
+        return node
+
+    def update(self, data={}, options={}, strategies=None):
         """
         Update the configuration with new data.
 
@@ -225,6 +778,12 @@ class ConfigNode(object):
             ...         'email': 'admin@lol'
             ...     }
             ... })
+
+        `strategies` is a dict of key paths and merge strategies to use when
+        merging `data` (see update_dict). Like the keys in `data`, the key
+        paths are relative to this node:
+
+            >>> c.server.update({'plugins': ['gzip']}, strategies={'plugins': APPEND})
         """
         # Handle an update with a set of options like CherryPy does
         for key in options:
@@ -233,19 +792,643 @@ class ConfigNode(object):
         # Merge in any data in `data`
         if isinstance(data, ConfigNode):
             data = data._get_value()
-        update_dict(self._get_value(), data)
+        if data:
+            strategies = compile_strategies(strategies)
+            if strategies and self._path:
+                # merges match strategies against key paths from the root
+                strategies = dict((self._path + k, v) for k, v in strategies.items())
+            self._root._override('_merge', self._path, data, strategies)
 
     def reset(self):
         """
-        Reset the config to defaults.
+        Reset the config by discarding any changes made at runtime.
+
+        This leaves the defaults and anything loaded from files or the
+        environment in place.
         """
-        self._data = copy.deepcopy(self._defaults)
+        root = self._root
+        if root._overrides:
+            root._overrides.clear()
+            root._dirty = True
+        root._rebuild()
 
     def to_dict(self):
         """
         Generate a plain dictionary.
+
+        This is a copy, so modifying it won't affect the config, or the
+        defaults and other data it was built from.
+        """
+        return _copy_tree(self._get_value())
+
+    def subscribe(self, key, callback):
+        """
+        Call `callback` whenever the value at a key path changes.
+
+        The callback is called with the key path, and the old and new values,
+        like this:
+
+            >>> def workers_changed(key, old, new):
+            ...     pool.resize(new)
+            >>> config.subscribe('server.workers', workers_changed)
+
+        Changes to anything inside the key path (e.g. 'server.workers.min' in
+        the above example) count as changes to its value. Callbacks are called
+        for changes made at runtime, as well as when a ConfigFile is reloaded.
+        """
+        path = self._path + self._compile(key)
+        root = self._root
+        with root._lock:
+            # build the section now, so later changes are compared against
+            # its real value rather than a section that hasn't been loaded
+            if path:
+                root._load_sections(path[:1])
+            root._subscribers.setdefault(path, []).append((key, callback))
+
+    def unsubscribe(self, key, callback):
+        """
+        Stop calling `callback` when the value at a key path changes.
+        """
+        path = self._path + self._compile(key)
+        subscribers = self._root._subscribers
+        subscribers[path] = [s for s in subscribers.get(path, []) if s[1] != callback]
+        if not subscribers[path]:
+            del subscribers[path]
+
+    def validate(self, schema=None):
+        """
+        Validate this node's data against a schema, filling in any defaults
+        and converting values to the right types.
+
+        `schema` is a Schema or a spec to create one from, and defaults to the
+        schema the config was created with. Raises a SchemaError if the data
+        doesn't match.
+        """
+        root = self._root
+        if schema is None:
+            schema = root._schema
+        elif not isinstance(schema, Schema):
+            schema = Schema(schema)
+        if schema is None:
+            raise ValueError("No schema to validate against")
+        with root._lock:
+            changes = schema.check(self._get_value())
+            if changes:
+                data = root._begin_write()
+                for path, value in changes:
+                    root._set(data, self._path + path, value)
+                root._data = data
+                root._version += 1
+        return self
+
+    def fingerprint(self):
+        """
+        Return a hash of this node's content, as a hex string.
+
+        Two nodes with the same content have the same fingerprint, so it can
+        be used to key caches of things built from part of the config:
+
+            >>> key = config.database.fingerprint()
+
+        Fingerprints are built from the fingerprints of each section below
+        the node, and are kept until something is written to the section or
+        underneath it, so after a change only the sections on the path down to
+        it are hashed again.
+        """
+        root = self._root
+        with root._lock:
+            node = root._hashes
+            for key in self._path:
+                node = node[1].setdefault(key, [None, {}])
+            return _fingerprint(self._get_value(), node)
+
+    def query(self, pattern):
         """
-        return self._get_value()
+        Find the values under this node whose key paths match a pattern, as a
+        list of (key path, value) pairs:
+
+            >>> config.query('clusters.*.nodes.*.port')
+            [('clusters.east.nodes.0.port', 8080), ...]
+
+        A pattern is a key path that can contain wildcards (see
+        compile_query). Key paths in the results are relative to this node,
+        and sections are returned as nodes, the same as reading them directly.
+
+        The data is walked without creating nodes for anything that doesn't
+        match, and the results are cached until the config next changes, so
+        running the same query again is cheap.
+        """
+        root = self._root
+        key = (self._path, pattern)
+        cached = root._query_results.get(key)
+        if cached is not None and cached[0] == root._version:
+            return list(cached[1])
+
+        matchers = compile_query(pattern)
+        if not self._path and root._pending:
+            if matchers and matchers[0][0] == QUERY_KEY:
+                root._load_sections([matchers[0][1]])
+            else:
+                root._load_sections(list(root._pending))
+        # read the version before the data, so if there's a write in between
+        # the results are cached under the old version and never used
+        version = root._version
+        value = root._data if not self._path else self._get_value()
+        found = []
+        _query(value, matchers, 0, (), found)
+        results = [(key, ConfigNode._view(root, self._path + path) if type(v) in NODE_TYPES else v)
+                   for key, (path, v) in zip(_key_paths(p for p, v in found), found)]
+
+        if len(root._query_results) >= QUERY_CACHE_SIZE:
+            root._query_results.clear()
+        root._query_results[key] = (version, results)
+        return list(results)
+
+    def diff(self, other):
+        """
+        Return a list of operations that would turn this node's data into
+        `other`'s (either another ConfigNode or a dict).
+
+        Each operation is either ('set', key path, value) or ('delete', key
+        path), with key paths relative to this node. Both trees are walked
+        once, and subtrees they share aren't walked at all, so diffing a
+        config against an updated copy of itself is cheap. Lists are compared
+        as whole values.
+
+        The result can be passed to `apply_patch()` on another config.
+        """
+        if isinstance(other, ConfigNode):
+            other = other._get_value()
+        mine = self._get_value()
+        if type(mine) != dict or type(other) != dict:
+            raise TypeError("Can only diff config sections")
+        return [(op, _key_path(path)) + args for op, path, args in diff_trees(mine, other)]
+
+    def apply_patch(self, ops):
+        """
+        Apply a list of operations from `diff()` to this node's data.
+
+        Like other changes made at runtime, the operations are kept across
+        reloads.
+        """
+        root = self._root
+        for op in ops:
+            path = op[1]
+            if isinstance(path, (tuple, list)):
+                path = tuple(path)
+            else:
+                path = self._compile(path)
+            if op[0] == 'set':
+                root._override('_set', self._path + path, op[2])
+            elif op[0] == 'delete':
+                root._override('_delete', self._path + path)
+            else:
+                raise ValueError("Unknown patch operation: {}".format(op[0]))
+
+    def start_profiling(self):
+        """
+        Start recording how the config is used, and return the ConfigProfile
+        the results are recorded in.
+
+        Reads and writes through nodes created from here on are counted and
+        timed per key path. Profiling swaps the root node's class for one that
+        records everything, so a config that isn't being profiled doesn't pay
+        anything for it.
+        """
+        root = self._root
+        root._profile = ConfigProfile(root)
+        if not isinstance(root, ProfiledConfigNode):
+            root.__class__ = _profiled_class(type(root))
+        return root._profile
+
+    def stop_profiling(self):
+        """
+        Stop recording how the config is used, and return the ConfigProfile
+        with the results.
+        """
+        root = self._root
+        profile = root._profile
+        root._profile = None
+        if isinstance(root, ProfiledConfigNode):
+            root.__class__ = type(root)._unprofiled
+        return profile
+
+    def dump_snapshot(self, path):
+        """
+        Write this node's data to a binary snapshot file, which can be loaded
+        much faster than YAML or JSON with `load_snapshot()`.
+
+        This is meant for building a config once (e.g. in a supervisor
+        process, with the defaults, config files and environment applied) and
+        passing it on to other processes on the same host. See
+        scruffy.snapshot.
+        """
+        snapshot.dump(self._get_value(), path)
+
+    @classmethod
+    def load_snapshot(cls, path, *args, **kwargs):
+        """
+        Create a config from a snapshot written by `dump_snapshot()`.
+
+        The snapshot becomes the config's defaults layer, and each top-level
+        section is only decoded when something in it is first read. Any other
+        arguments are passed to the constructor.
+        """
+        config = cls(*args, **kwargs)
+        config._set_layer('defaults', snapshot.load(path))
+        return config
+
+    def share_snapshot(self, name=None):
+        """
+        Put a snapshot of this node's data in shared memory, so that worker
+        processes can read it with `attach_snapshot()` rather than each
+        loading the config themselves.
+
+        Returns the multiprocessing.shared_memory.SharedMemory object, whose
+        `name` is passed to the workers. Keep it until they've attached, and
+        `close()` and `unlink()` it when it's no longer needed.
+        """
+        return snapshot.share(self._get_value(), name)
+
+    @classmethod
+    def attach_snapshot(cls, name, *args, **kwargs):
+        """
+        Create a config from a snapshot in shared memory created by
+        `share_snapshot()`.
+
+        Like `load_snapshot()`, sections are only decoded when they're read.
+        """
+        config = cls(*args, **kwargs)
+        config._set_layer('defaults', snapshot.attach(name))
+        return config
+
+    def freeze(self):
+        """
+        Return an immutable snapshot of this node's data.
+
+        See FrozenConfigNode.
+        """
+        return FrozenConfigNode(self._get_value())
+
+
+_set_root = ConfigNode._root.__set__
+_set_path = ConfigNode._path.__set__
+
+
+class ProfiledConfigNode(ConfigNode):
+    """
+    A ConfigNode that records reads and writes in its root's ConfigProfile.
+
+    The root node of a config that's being profiled is switched to a subclass
+    of this and its own class, and it creates ProfiledConfigNodes as its
+    children. See ConfigNode.start_profiling().
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        profile = self._root._profile
+        if profile is None:
+            return super(ProfiledConfigNode, self).__getitem__(key)
+        start = timer()
+        child = self._child(key)
+        value = child._get_value()
+        # anything but a section (including lists and missing values) counts
+        # as having been read as a whole
+        profile._read(child._path, timer() - start, type(value) != dict)
+        return child if type(value) in NODE_TYPES else value
+
+    def __setitem__(self, key, value):
+        super(ProfiledConfigNode, self).__setitem__(key, value)
+        if self._root._profile is not None:
+            self._root._profile._write(self._path + self._compile(key))
+
+    def __delitem__(self, key):
+        super(ProfiledConfigNode, self).__delitem__(key)
+        if self._root._profile is not None:
+            self._root._profile._write(self._path + self._compile(key))
+
+    def _child(self, path):
+        profile = self._root._profile
+        if profile is not None:
+            profile.children += 1
+        return ProfiledConfigNode._view(self._root, self._path + self._compile(path))
+
+    def _read_whole(self):
+        if self._root._profile is not None:
+            self._root._profile._values.add(self._path)
+
+    def items(self):
+        self._read_whole()
+        return super(ProfiledConfigNode, self).items()
+
+    def keys(self):
+        self._read_whole()
+        return super(ProfiledConfigNode, self).keys()
+
+    def __iter__(self):
+        self._read_whole()
+        return super(ProfiledConfigNode, self).__iter__()
+
+    def to_dict(self):
+        self._read_whole()
+        return super(ProfiledConfigNode, self).to_dict()
+
+    def update(self, data={}, options={}, strategies=None):
+        super(ProfiledConfigNode, self).update(data, options, strategies)
+        if data and self._root._profile is not None:
+            self._root._profile._write(self._path)
+
+
+_profiled_classes = {}
+
+
+def _profiled_class(cls):
+    """
+    Return a subclass of ProfiledConfigNode and `cls` for profiling a root
+    node of type `cls`.
+    """
+    try:
+        return _profiled_classes[cls]
+    except KeyError:
+        profiled = _profiled_classes[cls] = type('Profiled' + cls.__name__, (ProfiledConfigNode, cls),
+                                                 {'__slots__': (), '_unprofiled': cls})
+        return profiled
+
+
+timer = timeit.default_timer
+
+
+class ConfigProfile(object):
+    """
+    Records how a config is used while it's being profiled.
+
+    `reads` and `writes` map compiled key paths to the number of times each
+    was read or written, `read_time` maps them to the total time spent
+    resolving them, and `children` counts the nodes created while walking
+    down the tree.
+    """
+    def __init__(self, root):
+        self._root = root
+        self.reads = {}
+        self.read_time = {}
+        self.writes = {}
+        self.children = 0
+        self._values = set()
+
+    def _read(self, path, elapsed, value):
+        self.reads[path] = self.reads.get(path, 0) + 1
+        self.read_time[path] = self.read_time.get(path, 0) + elapsed
+        if value:
+            self._values.add(path)
+
+    def _write(self, path):
+        self.writes[path] = self.writes.get(path, 0) + 1
+
+    def hot_keys(self, count=10):
+        """
+        Return the `count` most read key paths, as a list of (key path,
+        reads, total time) tuples.
+        """
+        paths = sorted(self.reads, key=lambda p: (-self.reads[p], -self.read_time[p]))[:count]
+        return [(_key_path(p), self.reads[p], self.read_time[p]) for p in paths]
+
+    def never_read(self):
+        """
+        Return the key paths of values in the config that haven't been read,
+        either directly or as part of a section that was read as a whole.
+        Lists are treated as single values.
+        """
+        unread = []
+        stack = [((), self._root._get_value())]
+        while stack:
+            path, value = stack.pop()
+            if path in self._values:
+                continue
+            if type(value) == dict and value:
+                stack.extend((path + (k,), v) for k, v in value.items())
+            else:
+                unread.append(path)
+        return sorted((_key_path(p) for p in unread), key=str)
+
+    def to_dict(self, count=10):
+        """
+        Return a summary of the profile as a plain dict, including the
+        `count` hottest keys.
+        """
+        return {
+            'reads': sum(self.reads.values()),
+            'writes': sum(self.writes.values()),
+            'read_time': sum(self.read_time.values()),
+            'children': self.children,
+            'hot_keys': [{'key': k, 'reads': n, 'time': t} for k, n, t in self.hot_keys(count)],
+            'writes_by_key': dict((str(_key_path(p)), n) for p, n in self.writes.items()),
+            'never_read': [str(k) for k in self.never_read()],
+        }
+
+    def to_json(self, count=10):
+        """
+        Return the summary from `to_dict()` as JSON.
+        """
+        return json.dumps(self.to_dict(count), indent=4, sort_keys=True, default=str)
+
+
+class FrozenConfigNode(ConfigNode):
+    """
+    An immutable, precompiled snapshot of a config tree.
+
+    When the snapshot is created the tree is flattened into an index of
+    dotted key paths, with a precomputed node for every section. Reads, either
+    by key path or as attributes, are then a single dictionary lookup rather
+    than a walk down the tree:
+
+        >>> frozen = config.freeze()
+        >>> frozen['server.http.port']
+        >>> frozen.server.http.port
+
+    Any attempt to modify a frozen config raises a TypeError.
+    """
+    __slots__ = ('_index', '_prefix', '_value')
+
+    def __init__(self, data={}):
+        index = {}
+        data = copy.deepcopy(data)
+        FrozenConfigNode._init(self, self, index, '', data)
+
+        # flatten the tree into the index, creating nodes for all the sections
+        stack = [('', data)] if data else []
+        while stack:
+            prefix, value = stack.pop()
+            if type(value) == dict:
+                items = value.items()
+            else:
+                items = enumerate(value)
+            for k, v in items:
+                path = prefix + str(k)
+                if type(v) in NODE_TYPES:
+                    index[path] = FrozenConfigNode._init(object.__new__(FrozenConfigNode), self, index, path + '.', v)
+                    if v:
+                        stack.append((path + '.', v))
+                else:
+                    index[path] = v
+
+    @staticmethod
+    def _init(node, root, index, prefix, value):
+        """
+        Initialise a node's slots.
+        """
+        _set_root(node, root)
+        _set_path(node, ())
+        _set_index(node, index)
+        _set_prefix(node, prefix)
+        _set_value(node, value)
+        return node
+
+    def __getitem__(self, key):
+        try:
+            return self._index[self._prefix + key]
+        except TypeError:
+            key = str(key)
+            return self[key]
+        except KeyError:
+            return FrozenConfigNode._init(object.__new__(FrozenConfigNode), self._root, self._index,
+                                          self._prefix + key + '.', None)
+
+    def __setitem__(self, key, value):
+        raise TypeError("Can't modify a frozen config")
+
+    def __setattr__(self, key, value):
+        raise TypeError("Can't modify a frozen config")
+
+    def __delitem__(self, key):
+        raise TypeError("Can't modify a frozen config")
+
+    def __iter__(self):
+        if type(self._value) == list:
+            return (self[i] for i in range(len(self._value)))
+        return iter(self._value or ())
+
+    def items(self):
+        return [(k, self[k]) for k in self._value.keys()]
+
+    def _get_value(self):
+        return self._value
+
+    def _child(self, path):
+        raise TypeError("Can't make a view of a frozen config")
+
+    def update(self, data={}, options={}, strategies=None):
+        """
+        Frozen configs can't be updated.
+        """
+        if data or options:
+            raise TypeError("Can't modify a frozen config")
+
+    def reset(self):
+        """
+        Frozen configs can't be reset.
+        """
+        raise TypeError("Can't modify a frozen config")
+
+    def subscribe(self, key, callback):
+        """
+        Frozen configs never change, so they can't be subscribed to.
+        """
+        raise TypeError("Can't subscribe to a frozen config")
+
+    def unsubscribe(self, key, callback):
+        """
+        Frozen configs never change, so they can't be subscribed to.
+        """
+        raise TypeError("Can't subscribe to a frozen config")
+
+    def fingerprint(self):
+        hashes = self._root.__dict__.setdefault('_hashes', {})
+        try:
+            return hashes[self._prefix]
+        except KeyError:
+            digest = hashes[self._prefix] = _fingerprint(self._value, [None, {}])
+            return digest
+
+    def query(self, pattern):
+        cache = self._root.__dict__.setdefault('_query_results', {})
+        key = (self._prefix, pattern)
+        try:
+            return list(cache[key])
+        except KeyError:
+            pass
+        found = []
+        _query(self._value, compile_query(pattern), 0, (), found)
+        results = [(key, self._node(path, v)) for key, (path, v) in zip(_key_paths(p for p, v in found), found)]
+        if len(cache) >= QUERY_CACHE_SIZE:
+            cache.clear()
+        cache[key] = results
+        return list(results)
+
+    def _node(self, path, value):
+        """
+        Return what reading `value`, found at a compiled key path under this
+        node, would return.
+
+        Sections are looked up in the index, unless the dotted key path is
+        ambiguous (e.g. a key contains a dot) and the index has something
+        else there, in which case a new node is made for them.
+        """
+        if type(value) not in NODE_TYPES:
+            return value
+        if not path:
+            return self
+        prefix = self._prefix + '.'.join(str(k) for k in path)
+        node = self._index.get(prefix)
+        if isinstance(node, FrozenConfigNode) and node._value is value:
+            return node
+        return FrozenConfigNode._init(object.__new__(FrozenConfigNode), self._root, self._index, prefix + '.', value)
+
+    def apply_patch(self, ops):
+        """
+        Frozen configs can't be patched.
+        """
+        raise TypeError("Can't modify a frozen config")
+
+    def start_profiling(self):
+        """
+        Frozen configs can't be profiled.
+        """
+        raise TypeError("Can't profile a frozen config")
+
+    def validate(self, schema=None):
+        """
+        Validate the snapshot against a schema. Values can't be filled in or
+        converted, so any that would need to be raise a TypeError.
+
+        Frozen configs don't keep the schema they were created with, so
+        `schema` has to be given.
+        """
+        if schema is None:
+            raise TypeError("Can't validate a frozen config without a schema")
+        if not isinstance(schema, Schema):
+            schema = Schema(schema)
+        if schema.check(self._value):
+            raise TypeError("Can't modify a frozen config")
+        return self
+
+    def to_dict(self):
+        """
+        Generate a plain dictionary.
+
+        This is a copy, so modifying it won't affect the snapshot.
+        """
+        return copy.deepcopy(self._value)
+
+    def freeze(self):
+        """
+        Frozen configs are already frozen.
+        """
+        return self
+
+
+_set_index = FrozenConfigNode._index.__set__
+_set_prefix = FrozenConfigNode._prefix.__set__
+_set_value = FrozenConfigNode._value.__set__
 
 
 class Config(ConfigNode):
@@ -257,73 +1440,272 @@ class Config(ConfigNode):
 class ConfigEnv(ConfigNode):
     """
     Config based on based on environment variables.
+
+    Variables named with the prefix, like `SCRUFFY_SERVER.PORT=8080`, are
+    converted to key paths (`server.port`) and their values parsed. If
+    `defaults` are given, the type of the default at each key path decides
+    how the value is parsed; otherwise it's parsed as a Python literal if
+    possible, and left as a string if not.
+
+    Any `data` passed in sits underneath the environment, in place of a
+    config file.
     """
-    def __init__(self, prefix='SCRUFFY', *args, **kwargs):
-        super(ConfigEnv, self).__init__(*args, **kwargs)
+    def __init__(self, prefix='SCRUFFY', data={}, *args, **kwargs):
+        super(ConfigEnv, self).__init__({}, *args, **kwargs)
+        if isinstance(data, ConfigNode):
+            data = data._get_value()
+        self._layers['file'] = data
+        self._set_layer('env', environ(prefix, self._layers.get('defaults')))
 
-        # build options dictionary from environment variables starting with the prefix
-        options = {}
-        for key in [v for v in os.environ if v.startswith('__SC_') or v.startswith(prefix + '_')]:
-            try:
-                val = ast.literal_eval(os.environ[key])
-            except:
-                val = os.environ[key]
-            options[key.replace('__SC_', '').replace(prefix + '_', '').lower()] = val
 
-        # update config with the values we've found
-        self.update(options=options)
+def environ(prefix, defaults=None):
+    """
+    Build a dict of config data from environment variables starting with
+    `prefix`, using the types in `defaults` to parse their values (see
+    `coerce`).
+    """
+    prefixes = ('__SC_', prefix + '_')
+    layer = {}
+    for name in [name for name in os.environ if name.startswith(prefixes)]:
+        raw = os.environ[name]
+        for p in prefixes:
+            if name.startswith(p):
+                path = compile_path(name[len(p):].lower())
+                break
+
+        # build the nested dicts, overwriting any conflicting leaves
+        node = layer
+        for key in path[:-1]:
+            child = node.get(key)
+            if type(child) != dict:
+                child = node[key] = {}
+            node = child
+        node[path[-1]] = coerce(raw, _lookup(defaults, path))
+    return layer
+
+
+class ConfigCache(Directory):
+    """
+    A directory for caching parsed config files.
+
+    Each file's parsed data is pickled into the directory, along with the
+    file's path, modification time, size and a hash of its contents. As long
+    as those all still match, the file is loaded from the cache rather than
+    being parsed again.
+
+    The cache is loaded with pickle, so it must not be writable by anyone
+    who isn't trusted to run code as this user.
+    """
+    VERSION = 1
+
+    def parse(self, f):
+        """
+        Parse a File, using the cached data if the file hasn't changed.
+        """
+        path = os.path.abspath(f.path)
+        with open(path, 'rb') as fp:
+            raw = fp.read()
+            st = os.fstat(fp.fileno())
+        key = (self.VERSION, path, st.st_mtime, st.st_size, hashlib.sha1(raw).hexdigest())
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest() + '.cache'
+
+        # see if we've got a cached copy, any problem reading it is a miss
+        try:
+            with open(self.path_to(name), 'rb') as fp:
+                cached_key, data = pickle.load(fp)
+            if cached_key == key:
+                return data
+        except Exception:
+            pass
+
+        data = parse(raw.decode('utf-8'), f.ext)
+        try:
+            if not self.exists:
+                os.makedirs(self.path)
+            self.write(name, pickle.dumps((key, data), pickle.HIGHEST_PROTOCOL), mode='wb', atomic=True)
+        except (IOError, OSError):
+            pass
+        return data
 
 
 class ConfigFile(Config, File):
     """
     Config based on a loaded YAML or JSON file.
+
+    If `cache` is given (either a ConfigCache or the path to one), the parsed
+    config and defaults files are cached there, and later loads skip parsing
+    the files if they haven't changed.
+
+    Long-running programs can call `watch()` to have the file reloaded
+    whenever it changes, and `subscribe()` to be told about changes to the
+    parts of the config they care about.
+
+    If `schema` is given, the config is validated against it every time it's
+    loaded, and a reload that fails validation leaves the old config in place.
+
+    If `lazy` is set, only the config file's top-level keys are indexed when
+    it's loaded. Each top-level section is parsed the
+    first time something in it is read, so a process that only uses a few
+    sections of a large file never parses the rest. Anything that needs the
+    whole config (iterating over the root, `to_dict()`, `save()`, etc.) parses
+    everything that's left. Files that can't be split up (see LazyDocument),
+    and configs with interpolation or a schema, are loaded in full.
     """
-    def __init__(self, path=None, defaults=None, load=False, apply_env=False, env_prefix='SCRUFFY', *args, **kwargs):
+    def __init__(self, path=None, defaults=None, load=False, apply_env=False, env_prefix='SCRUFFY', cache=None,
+                 interpolate=False, strategies=None, schema=None, lazy=False, threadsafe=False, compact=False,
+                 *args, **kwargs):
         self._loaded = False
+        self._lazy = lazy
         self._defaults_file = defaults
         self._apply_env = apply_env
         self._env_prefix = env_prefix
-        Config.__init__(self)
+        if isinstance(cache, string_types):
+            cache = ConfigCache(cache)
+        self._cache = cache
+        self._stat = None
+        self._watcher = None
+        Config.__init__(self, interpolate=interpolate, strategies=strategies, threadsafe=threadsafe, compact=compact)
+        # only validate once the files have been loaded
+        self._schema = schema if schema is None or isinstance(schema, Schema) else Schema(schema)
         File.__init__(self, path=path, *args, **kwargs)
 
         if load:
             self.load()
 
-    def load(self, reload=False):
+    def load(self, reload=False, frozen=False):
         """
         Load the config and defaults from files.
+
+        Each of the defaults, the config file and the environment variables are
+        kept as a separate layer. Reloading only re-reads the config file, and
+        keeps any changes that have been made at runtime.
+
+        If `frozen` is set, an immutable FrozenConfigNode snapshot of the loaded
+        config is returned instead of the ConfigFile itself.
         """
         if reload or not self._loaded:
             # load defaults
-            if self._defaults_file and isinstance(self._defaults_file, string_types):
-                self._defaults_file = File(self._defaults_file, parent=self._parent)
-            defaults = {}
-            if self._defaults_file:
-                defaults = yaml.safe_load(self._defaults_file.read().replace('\t', '    '))
-
-            # load data
-            data = {}
-            if self.exists:
-                data = yaml.safe_load(self.read().replace('\t', '    '))
-
-            # initialise with the loaded data
-            self._defaults = defaults
-            self._data = copy.deepcopy(self._defaults)
-            self.update(data=data)
-
-            # if specified, apply environment variables
-            if self._apply_env:
-                self.update(ConfigEnv(self._env_prefix))
+            if not self._loaded:
+                if self._defaults_file and isinstance(self._defaults_file, string_types):
+                    self._defaults_file = File(self._defaults_file, parent=self._parent)
+                if self._defaults_file:
+                    self._layers['defaults'] = self._parse(self._defaults_file)
+
+                # if specified, apply environment variables
+                if self._apply_env:
+                    self._layers['env'] = environ(self._env_prefix, self._layers.get('defaults'))
+
+            # load data and rebuild the config on top of it, and only remember
+            # the file's details if that works, so a bad file is tried again
+            stat = self._file_stat()
+            self._set_layer('file', self._load_data())
+            self._stat = stat
 
             self._loaded = True
+            # changes made at runtime are replayed on top of the new file, so
+            # if there are any they still need saving
+            self._dirty = bool(self._overrides)
 
+        if frozen:
+            return self.freeze()
         return self
 
-    def save(self):
+    def _load_data(self):
+        """
+        Read and parse the config file, or return an empty dict if it doesn't
+        exist.
+        """
+        if self.exists:
+            if self._lazy:
+                doc = LazyDocument.index(self.path, self.ext)
+                if doc is not None:
+                    return doc
+            return self._parse(self)
+        return {}
+
+    def _parse(self, f):
+        """
+        Parse a File, using the cache if we have one.
+        """
+        if self._cache:
+            return self._cache.parse(f)
+        return parse(f.read(), f.ext)
+
+    def _file_stat(self):
+        """
+        Get the details of the config file used to tell whether it's changed.
+        """
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime, st.st_size, st.st_ino)
+        except (OSError, TypeError, AttributeError):
+            return None
+
+    def check(self):
+        """
+        Reload the config file if it has changed since it was last loaded.
+
+        This only stats the file, it isn't read or parsed unless it has been
+        modified. Returns True if the file was reloaded.
+        """
+        if self._loaded and self._file_stat() == self._stat:
+            return False
+        self.load(reload=True)
+        return True
+
+    def watch(self, interval=1.0):
+        """
+        Start a background thread that checks whether the config file has
+        changed every `interval` seconds, and reloads it if it has.
+        """
+        if self._watcher:
+            return
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.check()
+                except Exception:
+                    log.exception("Failed to reload config file {}".format(self.path))
+
+        thread = threading.Thread(target=run, name='scruffy-watch-{}'.format(self.name))
+        thread.daemon = True
+        thread.start()
+        self._watcher = (thread, stop)
+
+    def unwatch(self):
+        """
+        Stop the background thread started by `watch()`.
+        """
+        if self._watcher:
+            thread, stop = self._watcher
+            stop.set()
+            thread.join()
+            self._watcher = None
+
+    def save(self, force=False):
         """
         Save the config back to the config file.
+
+        Nothing is written if the config hasn't been modified since it was
+        loaded or last saved, unless `force` is set. The file is replaced
+        atomically, so anything reading it concurrently sees either the old or
+        the new version.
         """
-        self.write(yaml.safe_dump(self._data, default_flow_style=False))
+        if not self._dirty and not force:
+            return
+
+        # save any values that refer to other values as they were written
+        data = self._get_value()
+        if self._templates:
+            data = copy.deepcopy(data)
+            for path, (raw, template, deps, value) in self._templates.items():
+                _lookup(data, path[:-1])[path[-1]] = raw
+
+        self.write(yaml.dump(data, Dumper=SafeDumper, default_flow_style=False), atomic=True)
+        self._stat = self._file_stat()
+        self._dirty = False
 
     def prepare(self):
         """
@@ -332,12 +1714,215 @@ class ConfigFile(Config, File):
         self.load()
 
 
+class ConfigDirectory(ConfigFile):
+    """
+    Config loaded from all the YAML and JSON fragments in a directory, like a
+    conf.d directory.
+
+    The fragments are parsed in a pool of `workers` threads (by default one
+    per CPU, if concurrent.futures is available), and merged in order of
+    their file names to make up the config's file layer, on top of the
+    defaults. Files whose names start with a dot are ignored.
+
+    Everything else works like ConfigFile, except that the directory can't
+    be saved. `check()` and `watch()` pick up fragments being changed, added
+    or removed.
+    """
+    EXTENSIONS = ('.yaml', '.yml', '.json')
+
+    def __init__(self, path=None, defaults=None, load=False, workers=None, *args, **kwargs):
+        self._workers = workers
+        ConfigFile.__init__(self, path, defaults, load, *args, **kwargs)
+
+    def fragments(self):
+        """
+        Return a list of Files for the fragments in the directory, in the
+        order they're merged.
+        """
+        try:
+            names = sorted(os.listdir(self.path))
+        except (OSError, TypeError):
+            return []
+        return [File(os.path.join(self.path, name)) for name in names
+                if not name.startswith('.') and os.path.splitext(name)[1] in self.EXTENSIONS]
+
+    def _load_data(self):
+        files = self.fragments()
+        workers = min(self._workers or multiprocessing.cpu_count(), len(files))
+        if HAVE_FUTURES and workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                parsed = list(pool.map(self._parse, files))
+        else:
+            parsed = [self._parse(f) for f in files]
+        return merge_dicts({}, [d for d in parsed if d], self._strategies)
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+            stats = [(st.st_mtime, st.st_ino)]
+            for f in self.fragments():
+                st = os.stat(f.path)
+                stats.append((f.name, st.st_mtime, st.st_size, st.st_ino))
+            return tuple(stats)
+        except (OSError, TypeError):
+            return None
+
+    def save(self, force=False):
+        """
+        Config directories can't be saved.
+        """
+        raise TypeError("Can't save a config directory")
+
+
+class ConfigSource(ConfigFile):
+    """
+    Config loaded from a YAML or JSON document served over HTTP, like a key
+    in a key-value store's HTTP API.
+
+    The last good copy of the document is kept in `directory` (a Directory or
+    the path to one) along with its ETag and Last-Modified headers, and each
+    load after the first is a conditional request, so the server only sends
+    the document again if it has changed. If the server can't be reached, or
+    sends back something that can't be parsed, the local copy is used. If
+    `max_age` is given, a local copy fetched less than that many seconds ago
+    is used without asking the server at all, which spreads out the requests
+    when a lot of processes start at once.
+
+    Everything else works like ConfigFile: the document makes up the config's
+    file layer, on top of the defaults and underneath the environment, and
+    `check()` and `watch()` poll the server for changes. Sources can't be
+    saved.
+    """
+    EXTENSIONS = ('.yaml', '.yml', '.json')
+
+    def __init__(self, url, directory, defaults=None, load=False, timeout=10, max_age=None, headers=None,
+                 *args, **kwargs):
+        self._url = url
+        if isinstance(directory, string_types):
+            directory = Directory(directory)
+        self._directory = directory
+        self._timeout = timeout
+        self._max_age = max_age
+        self._headers = headers or {}
+        self._fetched = None
+
+        # the local copy is named after the URL, and keeps its extension so
+        # it's parsed the same way
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        ext = os.path.splitext(urlparse(url).path)[1]
+        self._copy = name + (ext if ext in self.EXTENSIONS else '.json')
+        self._meta = name + '.meta'
+        ConfigFile.__init__(self, directory.path_to(self._copy), defaults, load, *args, **kwargs)
+
+    def load(self, reload=False, frozen=False):
+        """
+        Fetch the document if it has changed, then load the config as
+        ConfigFile.load() does.
+        """
+        if reload or not self._loaded:
+            self.fetch()
+        return ConfigFile.load(self, reload, frozen)
+
+    def fetch(self):
+        """
+        Fetch the document if it has changed since the local copy was
+        fetched, and replace the local copy with it.
+
+        Returns True if there's a new local copy. If the request fails, the
+        local copy is left as it is, or if there isn't one the error is
+        raised.
+        """
+        meta = self._read_meta()
+        if self._max_age and self.exists and time.time() - meta.get('fetched', 0) < self._max_age:
+            return False
+
+        headers = dict(self._headers)
+        if self.exists:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = urlopen(Request(self._url, headers=headers), timeout=self._timeout)
+            try:
+                raw = response.read()
+                info = response.info()
+            finally:
+                response.close()
+            data = parse(raw.decode('utf-8'), self.ext)
+        except HTTPError as e:
+            if e.code == 304 and self.exists:
+                meta['fetched'] = time.time()
+                self._write_meta(meta)
+                return False
+            return self._fetch_failed(e)
+        except (IOError, OSError, ValueError, HTTPException, yaml.YAMLError) as e:
+            return self._fetch_failed(e)
+
+        if not self._directory.exists:
+            os.makedirs(self._directory.path)
+        self._directory.write(self._copy, raw, mode='wb', atomic=True)
+        self._write_meta({'url': self._url, 'etag': info.get('ETag'), 'last_modified': info.get('Last-Modified'),
+                          'fetched': time.time()})
+        self._fetched = data
+        return True
+
+    def _fetch_failed(self, error):
+        """
+        Fall back to the local copy after a failed fetch, or raise the error
+        if there isn't one.
+        """
+        if not self.exists:
+            raise error
+        log.warning("Failed to fetch config from {}, using the local copy: {}".format(self._url, error))
+        return False
+
+    def _read_meta(self):
+        try:
+            return json.loads(self._directory.read(self._meta))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_meta(self, meta):
+        self._directory.write(self._meta, json.dumps(meta), atomic=True)
+
+    def _load_data(self):
+        # use the document we just fetched rather than parsing it again
+        data, self._fetched = self._fetched, None
+        if data is not None:
+            return data
+        return ConfigFile._load_data(self)
+
+    def check(self):
+        """
+        Reload the config if the document has changed on the server since it
+        was last fetched. Returns True if it was reloaded.
+        """
+        if not self._loaded:
+            self.load()
+            return True
+        if not self.fetch():
+            return False
+        ConfigFile.load(self, reload=True)
+        return True
+
+    def save(self, force=False):
+        """
+        Config sources can't be saved.
+        """
+        raise TypeError("Can't save a config source")
+
+
 class ConfigApplicator(object):
     """
     Applies configs to other objects.
+
+    Strings are compiled into templates the first time they're seen, and
+    each config variable is only looked up once per applicator.
     """
     def __init__(self, config):
         self.config = config
+        self._values = {}
 
     def apply(self, obj):
         """
@@ -346,43 +1931,451 @@ class ConfigApplicator(object):
         if isinstance(obj, string_types):
             return self.apply_to_str(obj)
 
+    def apply_many(self, objs):
+        """
+        Apply the config to a number of objects in one pass, sharing compiled
+        templates and config lookups between them.
+
+        Strings are substituted and returned, and objects with an
+        `apply_config` method (e.g. the Files and Directories in a tree) have
+        it called with this applicator. Returns a list of the results.
+        """
+        results = []
+        for obj in objs:
+            if isinstance(obj, string_types):
+                obj = self.apply_to_str(obj)
+            elif hasattr(obj, 'apply_config'):
+                obj.apply_config(self)
+            results.append(obj)
+        return results
+
     def apply_to_str(self, obj):
         """
         Apply the config to a string.
         """
-        toks = re.split('({config:|})', obj)
+        template = compile_template(obj)
+        if template is None:
+            return obj
         newtoks = []
+        for op, tok in template:
+            if op == TEMPLATE_TEXT:
+                newtoks.append(tok)
+            elif op == TEMPLATE_VAR:
+                newtoks.append(self._value(tok))
+            else:
+                # the template was incomplete, leave the string as it is
+                return obj
+        return ''.join(newtoks)
+
+    def _value(self, var):
+        """
+        Look up a config variable, and return it as a string.
+        """
         try:
-            while len(toks):
-                tok = toks.pop(0)
-                if tok == '{config:':
-                    # pop the config variable, look it up
-                    var = toks.pop(0)
-                    val = self.config[var]
-
-                    # if we got an empty node, then it didn't exist
-                    if type(val) == ConfigNode and val == None:
-                        raise KeyError("No such config variable '{}'".format(var))
-
-                    # add the value to the list
-                    newtoks.append(str(val))
-
-                    # pop the '}'
-                    toks.pop(0)
-                else:
-                    # not the start of a config block, just append it to the list
-                    newtoks.append(tok)
-            return ''.join(newtoks)
-        except IndexError:
+            return self._values[var]
+        except KeyError:
+            pass
+        val = self.config[var]
+
+        # if we got an empty node, then it didn't exist
+        if isinstance(val, ConfigNode) and val == None:
+            raise KeyError("No such config variable '{}'".format(var))
+
+        val = self._values[var] = str(val)
+        return val
+
+
+# Operations in a compiled template
+TEMPLATE_TEXT, TEMPLATE_VAR, TEMPLATE_END = range(3)
+
+# Maximum number of compiled templates cached
+TEMPLATE_CACHE_SIZE = 4096
+
+_templates = {}
+
+
+def compile_template(s):
+    """
+    Compile a string containing `{config:...}` variables into a template for
+    ConfigApplicator.
+
+    A template is a tuple of (operation, token) pairs: TEMPLATE_TEXT for
+    literal text, TEMPLATE_VAR for a config variable to substitute, and
+    TEMPLATE_END if the string ends part way through a variable (in which case
+    it's left alone). Strings without any variables compile to None.
+
+    Compiled templates are cached.
+    """
+    try:
+        return _templates[s]
+    except KeyError:
+        pass
+
+    template = None
+    if '{config:' in s:
+        toks = re.split('({config:|})', s)
+        template = []
+        i = 0
+        while i < len(toks):
+            tok = toks[i]
+            i += 1
+            if tok == '{config:':
+                # the next token is the config variable, and the one after
+                # that should be the closing '}'
+                if i < len(toks):
+                    template.append((TEMPLATE_VAR, toks[i]))
+                if i + 1 >= len(toks):
+                    template.append((TEMPLATE_END, None))
+                    break
+                i += 2
+            elif tok:
+                template.append((TEMPLATE_TEXT, tok))
+        template = tuple(template)
+
+    if len(_templates) >= TEMPLATE_CACHE_SIZE:
+        _templates.clear()
+    _templates[s] = template
+    return template
+
+
+def compile_path(path):
+    """
+    Compile a key path into a tuple of keys.
+
+    A key path like 'thing.another.0.some_leaf' is split on dots, and any
+    component that looks like an integer is converted to one for list
+    access, giving ('thing', 'another', 0, 'some_leaf'). Non-string keys are
+    used as-is.
+    """
+    if not isinstance(path, string_types):
+        return (path,)
+    keys = []
+    for key in path.split('.'):
+        # See if the key could be an int for array access, if so assume it is
+        try:
+            key = int(key)
+        except ValueError:
             pass
+        keys.append(key)
+    return tuple(keys)
+
 
-        return obj
+# Kinds of component in a compiled query
+QUERY_KEY, QUERY_ANY, QUERY_GLOB, QUERY_DEEP = range(4)
 
+# Maximum number of compiled queries cached, and of query results cached per
+# config root
+QUERY_CACHE_SIZE = 1024
 
-def update_dict(target, source):
+# Characters that make a query component a glob pattern
+GLOB_CHARS = re.compile(r'[*?[]')
+
+_queries = {}
+
+
+def compile_query(pattern):
+    """
+    Compile a key path pattern for ConfigNode.query() into a tuple of (kind,
+    argument) pairs, one for each component of the path.
+
+    The pattern is split into keys like a key path. A '*' component matches
+    any one key or list index, '**' matches any number of levels (including
+    none), and components containing other glob characters, like 'web-*' or
+    'node[0-9]', are matched against each key with fnmatch. Any other
+    component is a key that's looked up directly.
     """
-    Recursively merge values from a nested dictionary into another nested
-    dictionary.
+    try:
+        return _queries[pattern]
+    except KeyError:
+        pass
+    matchers = []
+    for key in compile_path(pattern):
+        if key == '**':
+            matchers.append((QUERY_DEEP, None))
+        elif key == '*':
+            matchers.append((QUERY_ANY, None))
+        elif isinstance(key, string_types) and GLOB_CHARS.search(key):
+            matchers.append((QUERY_GLOB, re.compile(fnmatch.translate(key)).match))
+        else:
+            matchers.append((QUERY_KEY, key))
+    if len(_queries) >= QUERY_CACHE_SIZE:
+        _queries.clear()
+    matchers = _queries[pattern] = tuple(matchers)
+    return matchers
+
+
+def _query(value, matchers, i, path, found):
+    """
+    Find the values in a tree that match a compiled query from its `i`th
+    component on, and append them to `found` as (compiled key path, value)
+    pairs.
+    """
+    if i == len(matchers):
+        found.append((path, value))
+        return
+    kind, arg = matchers[i]
+    t = type(value)
+    if kind == QUERY_KEY:
+        if t == dict or t == list:
+            try:
+                child = value[arg]
+            except (KeyError, IndexError, TypeError):
+                return
+            _query(child, matchers, i + 1, path + (arg,), found)
+        return
+    if kind == QUERY_DEEP:
+        # match here with no levels in between, then carry on down
+        _query(value, matchers, i + 1, path, found)
+        i -= 1
+    if t == dict:
+        items = value.items()
+    elif t == list:
+        items = enumerate(value)
+    else:
+        return
+    for k, v in items:
+        if kind != QUERY_GLOB or arg(str(k)):
+            _query(v, matchers, i + 1, path + (k,), found)
+
+
+def _key_path(path):
+    """
+    Turn a compiled key path back into a dotted key path, or leave it as a
+    tuple if it has keys that wouldn't survive the round trip.
+    """
+    key = '.'.join(str(k) for k in path)
+    if path and compile_path(key) == path:
+        return key
+    return path
+
+
+def _key_paths(paths):
+    """
+    Turn a lot of compiled key paths back into dotted key paths, as
+    _key_path() does, checking each distinct key only once.
+    """
+    names = {}
+    results = []
+    for path in paths:
+        try:
+            parts = [names[k] for k in path]
+        except KeyError:
+            for k in path:
+                if k not in names:
+                    name = str(k)
+                    names[k] = name if compile_path(name) == (k,) else None
+            parts = [names[k] for k in path]
+        results.append('.'.join(parts) if path and None not in parts else path)
+    return results
+
+
+def diff_trees(a, b):
+    """
+    Compare two trees of plain data, and return a list of (op, key path,
+    args) tuples that would turn `a` into `b`, where `op` is 'set' or
+    'delete' and key paths are tuples.
+
+    Subtrees that are the same object in both trees are skipped without
+    being compared.
+    """
+    ops = []
+    stack = [((), a, b)]
+    while stack:
+        path, a, b = stack.pop()
+        for key in a:
+            if key not in b:
+                ops.append(('delete', path + (key,), ()))
+        for key, value in b.items():
+            old = a.get(key, _missing)
+            if old is value:
+                continue
+            if old is _missing:
+                ops.append(('set', path + (key,), (value,)))
+            elif type(old) == dict and type(value) == dict:
+                stack.append((path + (key,), old, value))
+            elif type(old) != type(value) or old != value:
+                ops.append(('set', path + (key,), (value,)))
+    return ops
+
+
+def compact(value, memo=None):
+    """
+    Return a copy of a tree of config data that takes up less memory.
+
+    String keys are interned, equal scalar values are replaced with a single
+    shared object, and equal lists and dicts that only contain scalars are
+    shared. Sharing containers like this is safe in a config's layers, as
+    the config copies any container it didn't create before writing to it.
+
+    `memo` is a dict used to find equal values, which can be shared between
+    calls to compact several trees together.
+    """
+    if memo is None:
+        memo = {}
+    t = type(value)
+    if t == dict:
+        items = [(_shared(intern(k) if type(k) is str else k, memo), compact(v, memo)) for k, v in value.items()]
+        key = (dict,) + tuple((id(k), id(v)) for k, v in items)
+    elif t == list:
+        items = [compact(v, memo) for v in value]
+        key = (list,) + tuple(id(v) for v in items)
+    else:
+        return _shared(value, memo)
+
+    if any(type(v) in (dict, list) for v in (items if t == list else (v for k, v in items))):
+        return t(items)
+    # everything in the container is a shared object, so equal containers
+    # have the same ids in the same order
+    try:
+        return memo[key]
+    except KeyError:
+        container = memo[key] = t(items)
+        return container
+
+
+def _shared(value, memo):
+    """
+    Return the shared copy of a scalar value from `memo`, adding it if it's
+    not there.
+    """
+    t = type(value)
+    # distinguish 0.0 from -0.0
+    key = (t, repr(value)) if t == float else (t, value)
+    try:
+        return memo.setdefault(key, value)
+    except TypeError:
+        return value
+
+
+def _fingerprint(value, node):
+    """
+    Hash a value, using and filling in the cached fingerprints in `node`, a
+    [fingerprint, children] trie mirroring the value's sections.
+    """
+    if node[0] is not None:
+        return node[0]
+    t = type(value)
+    if t == dict:
+        tag = 'd'
+        items = sorted(value.items(), key=lambda item: repr(item[0]))
+    elif t == list:
+        tag = 'l'
+        items = enumerate(value)
+    else:
+        return hashlib.sha1('{}:{!r}'.format(t.__name__, value).encode('utf-8')).hexdigest()
+    children = node[1]
+    parts = [tag]
+    for key, v in items:
+        if type(v) in NODE_TYPES:
+            child = children.get(key)
+            if child is None:
+                child = children[key] = [None, {}]
+            parts.append('{!r}\0#{}'.format(key, _fingerprint(v, child)))
+        else:
+            parts.append('{!r}\0{}:{!r}'.format(key, type(v).__name__, v))
+    node[0] = hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+    return node[0]
+
+
+def _overlaps(a, b):
+    """
+    Check whether one compiled key path is the same as, or inside, the other.
+    """
+    return a[:len(b)] == b or b[:len(a)] == a
+
+
+def _find_templates(value, path):
+    """
+    Find all the strings containing config variables in a tree of plain data.
+
+    Yields (path, string) tuples.
+    """
+    stack = [(path, value)]
+    while stack:
+        path, value = stack.pop()
+        if isinstance(value, string_types):
+            if '{config:' in value:
+                yield path, value
+        elif type(value) == dict:
+            stack.extend((path + (k,), v) for k, v in value.items())
+        elif type(value) == list:
+            stack.extend((path + (i,), v) for i, v in enumerate(value))
+
+
+def _copy_tree(value):
+    """
+    Copy a tree of config data, copying the dicts and lists directly rather
+    than going through deepcopy's memo.
+    """
+    t = type(value)
+    if t in SCALAR_TYPES:
+        return value
+    if t == dict:
+        return dict((k, v if type(v) in SCALAR_TYPES else _copy_tree(v)) for k, v in value.items())
+    if t == list:
+        return [v if type(v) in SCALAR_TYPES else _copy_tree(v) for v in value]
+    return copy.deepcopy(value)
+
+
+def _written_paths(op, path, args):
+    """
+    Generate the key paths a change made at runtime writes to, as (key path,
+    leaf) tuples, where `leaf` is set if it sets the whole value there.
+
+    `op`, `path` and `args` are as recorded by ConfigNode._override(). The
+    dicts on the way down to the key path are only created if they don't
+    exist, so they don't count.
+    """
+    if op != '_merge':
+        if op == '_delete' and type(path[-1]) == int:
+            # deleting from a list moves everything after it
+            path = path[:-1]
+        yield path, True
+        return
+    stack = [(path, args[0])]
+    while stack:
+        parent, value = stack.pop()
+        for k, v in value.items():
+            key_path = parent + (k,)
+            if isinstance(v, dict) and v:
+                yield key_path, False
+                stack.append((key_path, v))
+            else:
+                yield key_path, True
+
+
+def _lookup(data, path):
+    """
+    Get the value at a compiled key path in a tree of plain data, or None if
+    there isn't one.
+    """
+    for key in path:
+        try:
+            data = data[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return data
+
+
+def compile_strategies(strategies):
+    """
+    Compile a dict of key paths and merge strategies for update_dict.
+
+    Returns None if there aren't any strategies.
+    """
+    if not strategies:
+        return None
+    compiled = {}
+    for key, strategy in strategies.items():
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown merge strategy '{}'".format(strategy))
+        compiled[key if isinstance(key, tuple) else compile_path(key)] = strategy
+    return compiled
+
+
+def update_dict(target, source, strategies=None):
+    """
+    Merge values from a nested dictionary into another nested dictionary.
 
     For example:
 
@@ -409,10 +2402,84 @@ def update_dict(target, source):
             'c': 777
         }
     }
+
+    By default dicts are merged and any other values are replaced. This can
+    be changed for particular key paths with `strategies`, a dict of key
+    paths and one of REPLACE, APPEND, MERGE or KEEP_FIRST:
+
+    >>> update_dict(target, {'thang': {'a': 1}, 'list': [3]},
+    ...             strategies={'thang': REPLACE, 'list': APPEND})
+
+    Values from `source` are added to `target` by reference, not copied.
     """
-    for k,v in source.items():
-        if isinstance(v, dict) and k in target and isinstance(source[k], dict):
-            update_dict(target[k], v)
-        else:
-            target[k] = v
+    _merge_tree(target, source, compile_strategies(strategies))
+
+
+def merge_dicts(base, overlays, strategies=None):
+    """
+    Merge a list of nested dictionaries on top of `base`, like update_dict,
+    and return the result without modifying any of them.
+
+    Only the dicts that are merged into are copied; any subtree that's only
+    in one of the inputs is shared with it.
+    """
+    copies = {}
 
+    def writable(parent, key):
+        node = parent[key]
+        if id(node) not in copies:
+            node = parent[key] = dict(node)
+            copies[id(node)] = node
+        return node
+
+    result = dict(base)
+    copies[id(result)] = result
+    strategies = compile_strategies(strategies)
+    for overlay in overlays:
+        _merge_tree(result, overlay, strategies, writable)
+    return result
+
+
+def _merge_tree(target, source, strategies=None, writable=None, path=()):
+    """
+    Merge `source` into `target` in place, without recursion.
+
+    `strategies` are compiled merge strategies, and `path` is the key path of
+    `target` that they're relative to. If `writable` is given, it's called
+    with a container and a key to get a dict that can be merged into, rather
+    than modifying dicts inside `target` directly.
+    """
+    stack = [(path, target, source)]
+    while stack:
+        path, target, source = stack.pop()
+        if not strategies:
+            # fast path for the default strategy - merge dicts, replace anything else
+            for k, v in source.items():
+                if isinstance(v, dict):
+                    cur = target.get(k)
+                    if isinstance(cur, dict):
+                        stack.append((None, writable(target, k) if writable else cur, v))
+                        continue
+                target[k] = v
+            continue
+
+        for k, v in source.items():
+            cur = target.get(k, _missing)
+            if cur is _missing:
+                target[k] = v
+                continue
+            key_path = path + (k,)
+            strategy = strategies.get(key_path)
+            if strategy == KEEP_FIRST:
+                continue
+            elif strategy == APPEND and type(cur) == list and isinstance(v, list):
+                target[k] = cur + v
+            elif strategy != REPLACE and isinstance(v, dict) and isinstance(cur, dict):
+                if writable:
+                    cur = writable(target, k)
+                stack.append((key_path, cur, v))
+            else:
+                target[k] = v
+
+
+_missing = object()
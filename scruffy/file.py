@@ -8,15 +8,233 @@ from __future__ import unicode_literals
 import os
 from six import string_types
 import yaml
+import json
 import copy
 import logging
 import logging.config
 import inspect
 import pkg_resources
 import shutil
+import stat
+import tempfile
+import re
 
 from .plugin import PluginManager
 
+# use libyaml's loader and dumper if PyYAML was built with it, they're much faster
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+# file extensions that are parsed with the json module rather than as YAML
+JSON_EXTENSIONS = ('.json',)
+
+
+def parse(text, ext=None, expand_tabs=True):
+    """
+    Parse the contents of a YAML or JSON file into Python data.
+
+    `text` is the data to parse
+    `ext` is the extension of the file it came from, if it's one of
+        JSON_EXTENSIONS the data is parsed with the json module
+    `expand_tabs` if set, tabs are replaced with spaces before parsing YAML,
+        as YAML doesn't allow them for indentation (this also changes any tabs
+        in values)
+
+    JSON that the json module can't parse, and anything else, is parsed as
+    YAML.
+    """
+    if ext in JSON_EXTENSIONS:
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    if expand_tabs and '\t' in text:
+        text = text.replace('\t', '    ')
+    return yaml.load(text, Loader=SafeLoader)
+
+
+# lines after the first that start in the first column and aren't blank or
+# comments, and the keys of a top-level YAML block mapping
+YAML_TOP_LINE = re.compile(br'\n([^\s#][^\r\n]*)')
+YAML_TOP_KEY = re.compile(br'^("[^"\\\r\n]*"|\'[^\'\r\n]*\'|[^\s\'"?&*!|>%@`\[\]{},#:-][^\r\n]*?)[ \t]*:(?:[ \t]|$)')
+
+# anchors and aliases, which can refer across sections
+YAML_ANCHOR = re.compile(br'[&*][^\s,\[\]{}]')
+
+# comments, quoted scalars, and quotes that start a scalar but aren't closed
+YAML_QUOTED = re.compile(br'(?s)(?<!\S)#[^\n]*|(?<![^\s\[{,:])(?:"(?:[^"\\]|\\.)*"|\'(?:[^\']|\'\')*\'|(["\']))')
+
+
+class LazyDocument(object):
+    """
+    A YAML document whose top-level sections are parsed on demand.
+
+    The file is read into memory and scanned for the lines that start each
+    of its top-level keys, and each section is parsed the first time it's
+    accessed. The file isn't kept open or mapped, so it can be rewritten in
+    place without affecting sections that haven't been parsed yet. Use `index()` to create one, it returns None for documents that
+    can't be split up this way.
+
+    JSON isn't indexed, as the json module parses a whole document faster
+    than its sections can be found by scanning it in Python.
+    """
+    def __init__(self, buf, ext, offsets):
+        self._buf = buf
+        self._ext = ext
+        self._offsets = offsets
+        self._sections = {}
+
+    @classmethod
+    def index(cls, path, ext=None):
+        """
+        Read a file and index its top-level sections.
+
+        Returns None for JSON, documents that aren't a block mapping at the
+        top level, and documents that use features that mean their sections
+        can't be parsed separately (anchors and aliases, directives and
+        multiple documents).
+        """
+        if ext in JSON_EXTENSIONS:
+            return None
+        with open(path, 'rb') as f:
+            buf = f.read()
+        offsets = _index_yaml(buf) if buf else None
+        if offsets is None:
+            return None
+        return cls(buf, ext, offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def __getitem__(self, key):
+        try:
+            return self._sections[key]
+        except KeyError:
+            start, end = self._offsets[key]
+            value = self._sections[key] = self._decode(self._buf[start:end])
+            return value
+
+    def _decode(self, raw):
+        """
+        Parse the raw bytes of a section.
+        """
+        return next(iter(parse(raw.decode('utf-8'), self._ext).values()))
+
+    def items(self):
+        return [(key, self[key]) for key in self._offsets]
+
+    def load(self):
+        """
+        Parse any sections that haven't been parsed yet, and return the whole
+        document as a dict.
+        """
+        return dict(self.items())
+
+
+def _index_yaml(buf):
+    """
+    Find the offsets of each top-level section of a YAML block mapping.
+    """
+    # only bother with the regex if there's anything that could be an anchor
+    if buf.find(b'&') != -1 or buf.find(b'*') != -1:
+        for m in YAML_ANCHOR.finditer(buf):
+            if m.start() == 0 or buf[m.start() - 1:m.start()] in b' \t\r\n[{,':
+                return None
+
+    lines = [(m.start(1), m.group(1)) for m in YAML_TOP_LINE.finditer(buf)]
+    first = buf[:buf.find(b'\n')] if buf.find(b'\n') != -1 else buf[:]
+    if first[:1].strip() and first[:1] != b'#':
+        lines.insert(0, (0, first.rstrip(b'\r')))
+
+    offsets = {}
+    key = start = None
+    for pos, line in lines:
+        if line.rstrip() == b'---' and pos == 0:
+            continue
+        k = YAML_TOP_KEY.match(line)
+        if not k:
+            return None
+        if key is not None:
+            offsets[key] = (start, pos)
+        key = yaml.load(k.group(1).decode('utf-8'), Loader=SafeLoader)
+        start = pos
+        try:
+            hash(key)
+        except TypeError:
+            return None
+    if key is None:
+        return None
+    offsets[key] = (start, len(buf))
+
+    # YAML allows the lines of a quoted scalar or a flow collection to carry
+    # on in the first column, so make sure each section closes everything it
+    # opens rather than having been split part way through one
+    if any(buf.find(c) != -1 for c in (b'"', b"'", b'[', b'{')):
+        for start, end in offsets.values():
+            if not _closed(buf[start:end]):
+                return None
+    return offsets
+
+
+def _closed(section):
+    """
+    Check that the raw bytes of a YAML section don't end part way through a
+    quoted scalar or a flow collection.
+
+    Brackets are just counted, so any in scalars that don't balance out give
+    a false alarm, which only means the document is parsed in full.
+    """
+    if section.count(b'[') != section.count(b']') or section.count(b'{') != section.count(b'}'):
+        return False
+    if b'"' in section or b"'" in section:
+        for m in YAML_QUOTED.finditer(section):
+            if m.group(1):
+                return False
+    return True
+
+
+def atomic_write(path, data, mode='w'):
+    """
+    Write data to a file by writing it to a temporary file in the same
+    directory and renaming it over the original, so readers never see a
+    partially written file.
+
+    The new file gets the original's permissions and owner, or if there's no
+    original, the permissions `open()` would have created it with.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        try:
+            st = os.stat(path)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        else:
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except (AttributeError, OSError):
+                # only root can give files away
+                pass
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
 
 class File(object):
     """
@@ -128,15 +346,20 @@ class File(object):
             d = f.read()
         return d
 
-    def write(self, data, mode='w'):
+    def write(self, data, mode='w', atomic=False):
         """
         Write data to the file.
 
         `data` is the data to write
         `mode` is the mode argument to pass to `open()`
+        `atomic` if set, the data is written to a temporary file which is then
+            renamed over this one, so readers never see a partial write
         """
-        with open(self.path, mode) as f:
-            f.write(data)
+        if atomic:
+            atomic_write(self.path, data, mode)
+        else:
+            with open(self.path, mode) as f:
+                f.write(data)
 
 
 class LogFile(File):
@@ -221,13 +444,19 @@ class YamlFile(File):
         """
         Parse the file contents into a dictionary.
         """
-        return yaml.safe_load(self.read())
+        return parse(self.read(), self.ext, expand_tabs=False)
 
 
 class JsonFile(YamlFile):
     """
     A json file that is parsed into a dictionary.
     """
+    @property
+    def content(self):
+        """
+        Parse the file contents into a dictionary.
+        """
+        return parse(self.read(), '.json', expand_tabs=False)
 
 
 class PackageFile(File):
@@ -294,8 +523,7 @@ class Directory(object):
         if isinstance(self._path, string_types):
             self._path = applicator.apply(self._path)
 
-        for key in self._children:
-            self._children[key].apply_config(applicator)
+        applicator.apply_many(self._children.values())
 
     @property
     def path(self):
@@ -378,12 +606,18 @@ class Directory(object):
         """
         return [File(f, parent=self) for f in os.listdir(self.path)]
 
-    def write(self, filename, data, mode='w'):
+    def write(self, filename, data, mode='w', atomic=False):
         """
         Write to a file in the directory.
+
+        If `atomic` is set the data is written to a temporary file which is
+        then renamed into place.
         """
-        with open(self.path_to(str(filename)), mode) as f:
-            f.write(data)
+        if atomic:
+            atomic_write(self.path_to(str(filename)), data, mode)
+        else:
+            with open(self.path_to(str(filename)), mode) as f:
+                f.write(data)
 
     def read(self, filename):
         """
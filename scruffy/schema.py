@@ -0,0 +1,269 @@
+"""
+Schema
+------
+
+Classes for validating config data and converting it to the right types.
+"""
+import ast
+
+from six import string_types, integer_types
+
+
+class SchemaError(ValueError):
+    """
+    Raised when config data doesn't match a schema.
+
+    `errors` is a list of (key path, message) tuples, one for each problem
+    that was found.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(SchemaError, self).__init__('; '.join('{}: {}'.format(path, msg) for path, msg in errors))
+
+
+class Field(object):
+    """
+    A single value in a schema.
+
+    `type` is the type the value should be, or a tuple of types it can be.
+        Values of other types are converted to the first one they can be
+        (see `coerce`).
+    `required` if set, the value must be present
+    `default` is used if the value isn't present
+    `min` and `max` are the lowest and highest allowed values (or lengths,
+        for strings and lists)
+    `choices` is a list of allowed values
+    """
+    def __init__(self, type=None, required=False, default=None, min=None, max=None, choices=None):
+        self.type = type
+        self.required = required
+        self.default = default
+        self.min = min
+        self.max = max
+        self.choices = choices
+
+
+class Schema(object):
+    """
+    A declarative schema for config data.
+
+    The schema is a nested dict that mirrors the layout of the config, where
+    each value is either a Field, a type (short for a Field of that type), a
+    dict for a nested section, or a list containing a single schema that each
+    item in a list must match:
+
+        >>> schema = Schema({
+        ...     'server': {
+        ...         'host': Field(str, required=True),
+        ...         'port': Field(int, default=8080, min=1, max=65535),
+        ...         'debug': bool,
+        ...     },
+        ...     'backends': [{'url': Field(str, required=True), 'weight': float}]
+        ... })
+
+    The schema is compiled into a validator when it's created, so a Schema
+    object can be kept and reused to validate any number of configs.
+    Keys that aren't in the schema are allowed, and left alone.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self._check = _compile(spec)
+
+    def check(self, data):
+        """
+        Validate data against the schema in a single pass.
+
+        Returns a list of (key path, value) tuples for any values that need to
+        be set to defaults or converted to the right type, with the key paths
+        as tuples. The data itself isn't modified. Raises a SchemaError if
+        there are any problems that can't be fixed that way.
+        """
+        changes = []
+        errors = []
+        self._check(data, (), changes, errors)
+        if errors:
+            raise SchemaError(errors)
+        return changes
+
+    def validate(self, data):
+        """
+        Validate data against the schema, and return a copy of it with any
+        defaults filled in and values converted to the right types.
+
+        Only the containers that are changed are copied.
+        """
+        for path, value in self.check(data):
+            if not path:
+                data = value
+                continue
+            node = data = _copy(data)
+            for key in path[:-1]:
+                child = node.get(key) if type(node) == dict else node[key]
+                if child is None:
+                    child = {}
+                node[key] = child = _copy(child)
+                node = child
+            node[path[-1]] = value
+        return data
+
+
+def coerce(raw, default=None):
+    """
+    Convert a string (e.g. from an environment variable) into a value of the
+    same type as `default`.
+
+    If there's no default, or the string can't be converted to its type, it's
+    parsed as a Python literal, and if that fails it's returned as-is.
+    """
+    t = type(default)
+    try:
+        if t in string_types:
+            return raw
+        elif t == bool:
+            if raw.lower() in ('1', 'true', 'yes', 'on'):
+                return True
+            if raw.lower() in ('0', 'false', 'no', 'off', ''):
+                return False
+        elif t == int:
+            try:
+                return int(raw)
+            except ValueError:
+                return int(raw, 0)
+        elif t == float:
+            return float(raw)
+    except ValueError:
+        pass
+
+    try:
+        return ast.literal_eval(raw)
+    except Exception:
+        return raw
+
+
+def _copy(container):
+    if type(container) == dict:
+        return dict(container)
+    return list(container)
+
+
+def _format(path):
+    return '.'.join(str(k) for k in path) or '<root>'
+
+
+def _compile(spec):
+    """
+    Compile a schema spec into a function that checks a value against it.
+
+    The function is called with the value, its key path, and lists to add
+    changes and errors to.
+    """
+    if isinstance(spec, dict):
+        return _compile_section(spec)
+    elif isinstance(spec, list):
+        return _compile_list(spec)
+    elif isinstance(spec, Field):
+        return _compile_field(spec)
+    elif isinstance(spec, type) or (isinstance(spec, tuple) and all(isinstance(t, type) for t in spec)):
+        return _compile_field(Field(spec))
+    else:
+        raise TypeError("Don't know how to turn {} into a schema".format(type(spec)))
+
+
+def _compile_section(spec):
+    children = []
+    for key, child in spec.items():
+        field = child if isinstance(child, Field) else None
+        required = field is not None and field.required
+        default = field.default if field is not None else None
+        children.append((key, _compile(child), required, default))
+
+    def check(value, path, changes, errors):
+        if value is None:
+            value = {}
+        elif type(value) != dict:
+            errors.append((_format(path), 'expected a section, got {}'.format(type(value).__name__)))
+            return
+        for key, check_child, required, default in children:
+            v = value.get(key)
+            if v is None:
+                if default is not None:
+                    changes.append((path + (key,), default))
+                elif required:
+                    errors.append((_format(path + (key,)), 'missing required value'))
+                elif check_child.__name__ == 'check_section':
+                    # check for required values or defaults in the subsection
+                    check_child(None, path + (key,), changes, errors)
+            else:
+                check_child(v, path + (key,), changes, errors)
+    check.__name__ = 'check_section'
+    return check
+
+
+def _compile_list(spec):
+    if len(spec) != 1:
+        raise TypeError("List schemas must contain exactly one item schema")
+    check_item = _compile(spec[0])
+
+    def check(value, path, changes, errors):
+        if type(value) != list:
+            errors.append((_format(path), 'expected a list, got {}'.format(type(value).__name__)))
+            return
+        for i, v in enumerate(value):
+            check_item(v, path + (i,), changes, errors)
+    return check
+
+
+def _compile_field(field):
+    t = field.type
+    if t is not None and not isinstance(t, tuple):
+        t = (t,)
+    if t is not None and not all(isinstance(x, type) for x in t):
+        raise TypeError("Field types must be types or tuples of types")
+    lo, hi, choices = field.min, field.max, field.choices
+    names = ' or '.join(x.__name__ for x in t or ())
+
+    def check(value, path, changes, errors):
+        if t is not None and type(value) not in t:
+            for x in t:
+                converted = _convert(value, x)
+                if converted is not _invalid:
+                    break
+            else:
+                errors.append((_format(path), 'expected {}, got {!r}'.format(names, value)))
+                return
+            changes.append((path, converted))
+            value = converted
+        if lo is not None or hi is not None:
+            n = len(value) if t is not None and isinstance(value, SIZED_TYPES) else value
+            if lo is not None and n < lo:
+                errors.append((_format(path), '{!r} is less than the minimum of {}'.format(value, lo)))
+            if hi is not None and n > hi:
+                errors.append((_format(path), '{!r} is greater than the maximum of {}'.format(value, hi)))
+        if choices is not None and value not in choices:
+            errors.append((_format(path), '{!r} is not one of {!r}'.format(value, choices)))
+    return check
+
+
+_invalid = object()
+
+# Types whose min and max apply to their length
+SIZED_TYPES = tuple(string_types) + (list, dict)
+
+# Types that coerce() can convert strings to
+COERCED_TYPES = tuple(string_types) + (bool, int, float)
+
+
+def _convert(value, t):
+    """
+    Convert a value to type `t`, or return _invalid if it can't be.
+    """
+    if isinstance(value, t) and not (type(value) == bool and t != bool):
+        return value
+    if isinstance(value, string_types):
+        converted = coerce(value, t() if t in COERCED_TYPES else None)
+        return converted if type(converted) == t else _invalid
+    if t == float and type(value) in integer_types:
+        return float(value)
+    if t in string_types and type(value) in integer_types + (float,):
+        return str(value)
+    return _invalid
@@ -0,0 +1,228 @@
+"""
+Snapshot
+--------
+
+A compact binary format for config data that's much faster to load than
+YAML or JSON.
+
+A snapshot is a header, an index of the top-level keys, and each top-level
+section encoded separately (with marshal, or pickle for sections containing
+types marshal can't handle). Keys are interned before encoding so repeated
+keys are only stored once per section. Sections are decoded the first time
+they're read.
+
+Snapshots can also be put in shared memory (see `share()`), so that worker
+processes can all read the same copy rather than each loading their own.
+
+Snapshots are meant for passing config between processes on the same host,
+they can only be loaded by the same version of Python that wrote them.
+Sections encoded with pickle are loaded with pickle, so snapshots must not
+be writable by anyone who isn't trusted to run code as this user.
+"""
+import marshal
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+from six.moves import intern
+from .file import LazyDocument, atomic_write
+
+try:
+    from multiprocessing import shared_memory
+    HAVE_SHARED_MEMORY = True
+except ImportError:
+    HAVE_SHARED_MEMORY = False
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+
+# names of the blocks of shared memory created by share() in this process,
+# which its resource tracker (shared with any forked children) is tracking
+_shared = set()
+
+# pids of resource trackers started by a parent process before this one was
+# forked from it
+_inherited = set()
+
+if resource_tracker is not None and hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: _inherited.add(resource_tracker._resource_tracker._pid))
+
+MAGIC = b'SCRUFFYS'
+VERSION = 1
+
+# magic, format version, python major and minor version, marshal version,
+# index codec, index length
+HEADER = struct.Struct('<8sHBBBB2xQ')
+
+# how each section (and the index) is encoded
+MARSHAL = 0
+PICKLE = 1
+
+
+def dump(data, path):
+    """
+    Write a dict of config data to a snapshot file.
+
+    The file is replaced atomically.
+    """
+    atomic_write(path, encode(data), mode='wb')
+
+
+def encode(data):
+    """
+    Encode a dict of config data as a snapshot.
+    """
+    if type(data) != dict:
+        raise TypeError("Can only snapshot a dict, not {}".format(type(data).__name__))
+    blobs = []
+    index = {}
+    offset = 0
+    for key, value in data.items():
+        blob = _encode(_intern_keys(value))
+        index[key] = (offset, offset + len(blob))
+        offset += len(blob)
+        blobs.append(blob)
+
+    index = _encode(index)
+    header = HEADER.pack(MAGIC, VERSION, sys.version_info[0], sys.version_info[1], marshal.version,
+                         ord(index[:1]), len(index) - 1)
+    return b''.join([header, index[1:]] + blobs)
+
+
+def load(path):
+    """
+    Open a snapshot file.
+
+    Returns a SnapshotDocument, which decodes each section the first time
+    it's read. Raises a ValueError if the file isn't a snapshot, or was
+    written by a different version of Python or scruffy.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("{} is empty".format(path))
+    try:
+        return open_buffer(buf, path)
+    except ValueError:
+        buf.close()
+        raise
+
+
+def open_buffer(buf, name='buffer'):
+    """
+    Open a snapshot in a buffer (anything that supports slicing, like bytes,
+    an mmap or a memoryview). `name` is used in error messages.
+    """
+    try:
+        magic, version, major, minor, marshal_version, codec, length = HEADER.unpack(buf[:HEADER.size])
+    except struct.error:
+        magic = None
+    if magic != MAGIC:
+        raise ValueError("{} isn't a config snapshot".format(name))
+    if (version, major, minor, marshal_version) != (VERSION, sys.version_info[0], sys.version_info[1],
+                                                    marshal.version):
+        raise ValueError("{} was written by an incompatible version".format(name))
+    start = HEADER.size + length
+    index = _decode(buf[HEADER.size:start], codec)
+    offsets = dict((key, (start + a, start + b)) for key, (a, b) in index.items())
+    return SnapshotDocument(buf, None, offsets)
+
+
+def share(data, name=None):
+    """
+    Encode a dict of config data as a snapshot in a new block of shared
+    memory, so that other processes on the host can `attach()` to it.
+
+    Returns the multiprocessing.shared_memory.SharedMemory object. The caller
+    must keep it until the other processes have attached, and `close()` and
+    `unlink()` it once it's no longer needed.
+    """
+    if not HAVE_SHARED_MEMORY:
+        raise ImportError("multiprocessing.shared_memory isn't available")
+    raw = encode(data)
+    shm = shared_memory.SharedMemory(name, create=True, size=len(raw))
+    shm.buf[:len(raw)] = raw
+    _shared.add(shm._name)
+    return shm
+
+
+def attach(name):
+    """
+    Open a snapshot created by `share()` in another process.
+
+    Nothing is copied or decoded until a section is read, and each section is
+    decoded straight out of the shared memory.
+
+    Before Python 3.13, processes started by the one that called `share()`
+    (with any start method) share its resource tracker, and leave the
+    creator's registration alone. A process that shares the resource tracker
+    of a parent that didn't create the block leaves it registered there too,
+    so it will be unlinked when the parent exits.
+    """
+    if not HAVE_SHARED_MEMORY:
+        raise ImportError("multiprocessing.shared_memory isn't available")
+    # don't let this process's resource tracker unlink it on exit
+    try:
+        shm = shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching always registers it with the tracker,
+        # so take it off again if the tracker is this process's own and it
+        # isn't the creator's registration
+        shm = shared_memory.SharedMemory(name)
+        if resource_tracker is not None and shm._name not in _shared and _owns_tracker():
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    doc = open_buffer(shm.buf, name)
+    doc._shm = shm
+    return doc
+
+
+def _owns_tracker():
+    """
+    Whether this process started its resource tracker itself, rather than
+    inheriting it from a parent (as processes started with fork, spawn or
+    forkserver do).
+    """
+    pid = resource_tracker._resource_tracker._pid
+    return pid is not None and pid not in _inherited
+
+
+class SnapshotDocument(LazyDocument):
+    """
+    A snapshot file whose top-level sections are decoded on demand.
+    """
+    def _decode(self, raw):
+        return _decode(raw[1:], bytearray(raw[:1])[0])
+
+
+def _encode(value):
+    """
+    Encode a value with marshal, or pickle if that fails, prefixed with a
+    byte saying which was used.
+    """
+    try:
+        return b'\x00' + marshal.dumps(value)
+    except ValueError:
+        return b'\x01' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _decode(raw, codec):
+    if codec == MARSHAL:
+        return marshal.loads(raw)
+    return pickle.loads(raw)
+
+
+def _intern_keys(value):
+    """
+    Return a copy of a tree of config data with all its string keys interned.
+    """
+    t = type(value)
+    if t == dict:
+        return dict((intern(k) if type(k) is str else k, _intern_keys(v)) for k, v in value.items())
+    elif t == list:
+        return [_intern_keys(v) for v in value]
+    return value
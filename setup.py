@@ -14,6 +14,6 @@ setup(
     license="MIT",
     keywords="scruffy",
     url="https://github.com/snare/scruffy",
-    packages=['scruffy'],
+    packages=['scruffy', 'scruffy.bench'],
     install_requires=['pyyaml', 'six'],
 )
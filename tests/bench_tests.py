@@ -0,0 +1,12 @@
+import json
+
+from scruffy import bench
+
+
+def test_bench_run_report():
+    results = bench.run('config', repeat=1, match='read, shallow')
+    assert [name for name, secs in results] == ['read, shallow key path']
+    assert results[0][1] > 0
+    report = json.loads(json.dumps(bench.report({'config': results}, 'test')))
+    assert report['label'] == 'test'
+    assert list(report['results']['config']) == ['read, shallow key path']
@@ -1,4 +1,11 @@
 import yaml
+import json
+import shutil
+import stat
+import tempfile
+import time
+import threading
+import scruffy.config
 import os
 from six import string_types
 
@@ -137,6 +144,17 @@ def test_config_env():
     del os.environ['THING_TEST.A.A.C']
     del os.environ['THING_TEST.A.A.D']
 
+    # the environment wins over data passed in
+    os.environ['SCRUFFY_A'] = '2'
+    try:
+        c = ConfigEnv(data={'a': 1, 'b': 1})
+        assert c == {'a': 2, 'b': 1}
+        c.b = 3
+        c.reset()
+        assert c == {'a': 2, 'b': 1}
+    finally:
+        del os.environ['SCRUFFY_A']
+
 def test_config_yaml():
     c = ConfigFile('tests/env1/yaml_config', defaults='tests/env1/default.cfg', load=True)
     assert c.setting1 == 666
@@ -157,3 +175,735 @@ def test_config_applicator():
         assert False
     except KeyError:
         assert True
+
+def test_config_key_path_cache():
+    c = Config(data={'a': {'b': [{'c': 1}, {'c': 2}]}})
+    assert c['a.b.1.c'] == 2
+    assert c._paths['a.b.1.c'] == ('a', 'b', 1, 'c')
+    assert c.a._compile('b.1') is c._paths['b.1']
+    import scruffy.config
+    size = scruffy.config.PATH_CACHE_SIZE
+    scruffy.config.PATH_CACHE_SIZE = 2
+    try:
+        for i in range(5):
+            c['x{}'.format(i)]
+        assert len(c._paths) <= 2
+    finally:
+        scruffy.config.PATH_CACHE_SIZE = size
+
+def test_config_child_view():
+    c = Config(defaults={'a': {'b': {'c': 1}}})
+    n = c.a.b
+    assert type(n) == ConfigNode
+    assert n._root is c
+    assert n._path == ('a', 'b')
+    assert not vars(n)
+    n.d = 2
+    assert c['a.b.d'] == 2
+    assert ConfigNode(root=c, path='a.b').c == 1
+
+def test_config_freeze():
+    d = yaml.safe_load(YAML)
+    c = Config(data=d)
+    f = c.freeze()
+    assert isinstance(f, ConfigNode)
+    assert f.thang.d.b == 2
+    assert f['thang']['d']['b'] == 2
+    assert f['thang.d.b'] == 2
+    assert f.derp[0] == {'a': 1}
+    assert f.derp[0].a == 1
+    assert f['derp.1.a'] == 2
+    assert f.another[2] == 888
+    assert f.xxx == None
+    assert f.xxx.yyy == None
+    if f.xxx:
+        assert False
+    assert f.thang.d is f.thang.d
+    assert dict(f.thang.d.items()) == {'a': 1, 'b': 2, 'c': 3}
+    assert [n.a for n in f.derp] == [1, 2, 3, 4]
+    assert f.to_dict() == d
+    for op in [lambda: setattr(f, 'thing', 1), lambda: f.thang.__setitem__('a', 1),
+               lambda: f.update(options={'thing': 1}), lambda: f.update({'thing': 1}, strategies={'thing': REPLACE}),
+               f.reset, lambda: f.subscribe('thing', len), lambda: f.thang.unsubscribe('a', len),
+               lambda: f._child('thang'), f.validate]:
+        try:
+            op()
+            assert False
+        except TypeError as e:
+            assert 'frozen' in str(e)
+    assert_raises(AttributeError, f.derp.items)
+    assert_raises(AttributeError, c.derp.items)
+    c.thing = 666
+    assert f.thing == 123
+
+def test_config_file_frozen():
+    c = ConfigFile('tests/env1/yaml_config', defaults='tests/env1/default.cfg').load(frozen=True)
+    assert type(c) == FrozenConfigNode
+    assert c.setting1 == 666
+    assert c['setting3.key1'] == "value"
+
+def test_config_layers():
+    defaults = {'a': {'b': 1, 'c': [1, 2]}, 'x': {'y': 1}}
+    c = Config(defaults=defaults)
+    c.to_dict()['x']['y'] = 99
+    c.x.to_dict()['y'] = 99
+    assert defaults['x'] == {'y': 1}
+    assert c.x.y == 1
+    c.a.b = 2
+    c['a.c.0'] = 3
+    c.update({'x': {'z': 2}})
+    assert c.a == {'b': 2, 'c': [3, 2]}
+    assert c.x == {'y': 1, 'z': 2}
+    assert defaults == {'a': {'b': 1, 'c': [1, 2]}, 'x': {'y': 1}}
+    c.reset()
+    assert c == defaults
+
+    # scalars are shared, but anything that could be modified is copied
+    c = Config(defaults={'s': set([1]), 'l': [u'x', b'y', 1.5, None, set([2])]})
+    d = c.to_dict()
+    d['s'].add(3)
+    d['l'][-1].add(3)
+    assert d['l'][:4] == [u'x', b'y', 1.5, None]
+    assert c.s == set([1])
+    assert c.l[4] == set([2])
+
+def test_config_file_reload():
+    p = '/tmp/scruffy_test_config.yaml'
+    with open(p, 'w') as f:
+        f.write('a: 1\nb: 2\n')
+    c = ConfigFile(p, defaults='tests/env1/default.cfg', load=True)
+    c.a = 3
+    assert c.a == 3
+    assert c.b == 2
+    with open(p, 'w') as f:
+        f.write('b: 4\n')
+    c.load(reload=True)
+    assert c.a == 3
+    assert c.b == 4
+    assert c.setting1 == 666
+    c.reset()
+    assert c.a == None
+    assert c.b == 4
+    os.unlink(p)
+
+def test_config_cache():
+    d = '/tmp/scruffy_test_cache'
+    p = '/tmp/scruffy_test_cached.yaml'
+    shutil.rmtree(d, True)
+    with open(p, 'w') as f:
+        f.write('a: 1\n')
+    c = ConfigFile(p, defaults='tests/env1/default.cfg', cache=d, load=True)
+    assert c.a == 1
+    assert c.setting1 == 666
+    assert len(os.listdir(d)) == 2
+    orig = scruffy.config.parse
+    scruffy.config.parse = None
+    try:
+        c = ConfigFile(p, defaults='tests/env1/default.cfg', cache=d, load=True)
+        assert c.a == 1
+        assert c.setting1 == 666
+    finally:
+        scruffy.config.parse = orig
+    with open(p, 'w') as f:
+        f.write('a: 2\n')
+    assert c.load(reload=True).a == 2
+    shutil.rmtree(d, True)
+    os.unlink(p)
+
+def test_config_subscribe():
+    changes = []
+    def callback(key, old, new):
+        changes.append((key, old, new))
+    c = Config(defaults={'server': {'workers': 4, 'host': 'localhost'}})
+    c.subscribe('server.workers', callback)
+    c.server.subscribe('host', callback)
+    c.server.workers = 4
+    assert changes == []
+    c.server.workers = 8
+    assert changes == [('server.workers', 4, 8)]
+    c.update({'server': {'host': 'example.com'}})
+    assert changes[1] == ('host', 'localhost', 'example.com')
+    c.reset()
+    assert sorted(changes[2:]) == [('host', 'example.com', 'localhost'), ('server.workers', 8, 4)]
+    c.unsubscribe('server.workers', callback)
+    c.server.workers = 16
+    assert len(changes) == 4
+
+def test_config_file_watch():
+    p = '/tmp/scruffy_test_watch.yaml'
+    with open(p, 'w') as f:
+        f.write('server:\n    workers: 4\n')
+    changes = []
+    c = ConfigFile(p, load=True)
+    c.subscribe('server.workers', lambda key, old, new: changes.append((old, new)))
+    assert not c.check()
+    with open(p, 'w') as f:
+        f.write('server:\n    workers: 8\n    host: x\n')
+    assert c.check()
+    assert changes == [(4, 8)]
+    c.watch(interval=0.01)
+    with open(p, 'w') as f:
+        f.write('server:\n    workers: 16\n')
+    for i in range(500):
+        if len(changes) == 2:
+            break
+        time.sleep(0.01)
+    c.unwatch()
+    assert changes == [(4, 8), (8, 16)]
+    os.unlink(p)
+
+def test_config_file_save():
+    p = '/tmp/scruffy_test_save.yaml'
+    with open(p, 'w') as f:
+        f.write('a: 1\n')
+    c = ConfigFile(p, load=True)
+    c.save()
+    with open(p) as f:
+        assert f.read() == 'a: 1\n'
+    os.utime(p, (0, 0))
+    c.save()
+    assert os.stat(p).st_mtime == 0
+    os.chmod(p, 0o644)
+    c.b = {'c': 2}
+    c.save()
+    assert stat.S_IMODE(os.stat(p).st_mode) == 0o644
+    assert ConfigFile(p, load=True) == {'a': 1, 'b': {'c': 2}}
+    assert not c.check()
+    os.utime(p, (0, 0))
+    c.save()
+    assert os.stat(p).st_mtime == 0
+    c.update({'b': {'d': 3}})
+    c.save()
+    assert ConfigFile(p, load=True).b == {'c': 2, 'd': 3}
+
+    # unsaved changes survive the file being reloaded
+    c = ConfigFile(p, load=True)
+    c['a'] = 5
+    with open(p, 'w') as f:
+        f.write('a: 1\nb: 2\n')
+    c.load(reload=True)
+    c.save()
+    assert ConfigFile(p, load=True) == {'a': 5, 'b': 2}
+    os.unlink(p)
+
+def test_config_env_types():
+    os.environ['SCRUFFY_SERVER.PORT'] = '0x50'
+    os.environ['SCRUFFY_SERVER.NAME'] = '123'
+    os.environ['SCRUFFY_SERVER.DEBUG'] = 'yes'
+    os.environ['SCRUFFY_SERVER.TIMEOUT'] = '5'
+    os.environ['SCRUFFY_SERVER.OTHER'] = '[1, 2]'
+    defaults = {'server': {'port': 8080, 'name': 'x', 'debug': False, 'timeout': 1.5}}
+    c = ConfigEnv(defaults=defaults)
+    assert c.server == {'port': 80, 'name': '123', 'debug': True, 'timeout': 5.0, 'other': [1, 2]}
+    assert type(c.server.timeout) == float
+    for k in ['PORT', 'NAME', 'DEBUG', 'TIMEOUT', 'OTHER']:
+        del os.environ['SCRUFFY_SERVER.' + k]
+
+def test_config_applicator_many():
+    ap = ConfigApplicator(Config(data={'base': '/tmp', 'name': 'x', 'n': 1}))
+    assert scruffy.config.compile_template('/a/{config:base}/b') == (
+        (scruffy.config.TEMPLATE_TEXT, '/a/'), (scruffy.config.TEMPLATE_VAR, 'base'),
+        (scruffy.config.TEMPLATE_TEXT, '/b'))
+    assert scruffy.config.compile_template('/a/b}') is None
+    assert ap.apply('{config:base}') == '/tmp'
+    assert ap.apply('{config:base') == '{config:base'
+    d = Directory('{config:base}', f=File('{config:name}.{config:n}'))
+    assert ap.apply_many(['{config:base}/{config:name}', 'plain', d]) == ['/tmp/x', 'plain', d]
+    assert d.f.path == '/tmp/x.1'
+
+def test_config_interpolate():
+    c = Config(interpolate=True, defaults={
+        'paths': {'base': '/srv', 'log': '{config:paths.base}/log', 'app': '{config:paths.log}/app.log'},
+        'server': {'port': 8080, 'other_port': '{config:server.port}', 'ports': ['{config:server.port}']},
+    })
+    assert c.paths.log == '/srv/log'
+    assert c.paths.app == '/srv/log/app.log'
+    assert c.server.other_port == 8080
+    assert c.server.ports[0] == 8080
+    c.paths.base = '/opt'
+    assert c.paths.log == '/opt/log'
+    assert c.paths.app == '/opt/log/app.log'
+    c.update({'paths': {'log': '{config:paths.base}/logs'}})
+    assert c.paths.app == '/opt/logs/app.log'
+    c.paths.log = '/var/log'
+    assert c.paths.app == '/var/log/app.log'
+    c.reset()
+    assert c.paths.app == '/srv/log/app.log'
+
+    # setting a value to what it resolved to still replaces the reference
+    c = Config(defaults={'n': 5, 'm': '{config:n}', 'l': ['{config:n}']}, interpolate=True)
+    c.m = 5
+    c['l.0'] = 5
+    c.n = 6
+    assert c.m == 5
+    assert c.l == [5]
+    c.update({'l': ['{config:n}']})
+    c.update({'n': 7})
+    assert c.l == [7]
+    try:
+        Config(interpolate=True, data={'a': '{config:b}', 'b': 'x{config:c}', 'c': '{config:a}'})
+        assert False
+    except ValueError:
+        pass
+    try:
+        Config(interpolate=True, data={'a': '{config:b}'})
+        assert False
+    except KeyError:
+        pass
+    assert Config(data={'a': '{config:b}'}).a == '{config:b}'
+
+    # referenced sections are copied, and bad references leave the tree alone
+    c = Config(interpolate=True, defaults={'a': {'x': 1}, 'b': '{config:a}'})
+    c['a.y'] = 1
+    c['b.x'] = 5
+    assert c.a == {'x': 1, 'y': 1}
+    assert c.b == {'x': 1, 'y': 1}
+    assert c._data['a'] is not c._data['b']
+    assert_raises(KeyError, c.__setitem__, 'b', '{config:nope}')
+    assert c.b == {'x': 1, 'y': 1}
+    c.a.x = 2
+    assert c.b.x == 2
+
+def test_config_file_interpolate_save():
+    p = '/tmp/scruffy_test_interpolate.yaml'
+    with open(p, 'w') as f:
+        f.write('base: /srv\nlog: "{config:base}/log"\n')
+    c = ConfigFile(p, interpolate=True, load=True)
+    assert c.log == '/srv/log'
+    c.base = '/opt'
+    c.save()
+    c = ConfigFile(p, load=True)
+    assert c.log == '{config:base}/log'
+    assert c.base == '/opt'
+    os.unlink(p)
+
+def test_update_dict_strategies():
+    target = {'a': {'b': 1, 'c': 2}, 'l': [1], 'k': 1, 'd': {'x': 1}}
+    scruffy.config.update_dict(target, {'a': {'b': 3}, 'l': [2], 'k': 2, 'd': {'y': 2}, 'n': 1},
+                               strategies={'l': APPEND, 'k': KEEP_FIRST, 'd': REPLACE})
+    assert target == {'a': {'b': 3, 'c': 2}, 'l': [1, 2], 'k': 1, 'd': {'y': 2}, 'n': 1}
+    try:
+        scruffy.config.update_dict(target, {}, strategies={'a': 'xxx'})
+        assert False
+    except ValueError:
+        pass
+
+def test_merge_dicts():
+    base = {'a': {'b': 1}, 'x': {'y': [1]}}
+    overlays = [{'a': {'c': 2}}, {'a': {'b': 3}, 'x': {'y': [2]}}]
+    merged = scruffy.config.merge_dicts(base, overlays, strategies={'x.y': APPEND})
+    assert merged == {'a': {'b': 3, 'c': 2}, 'x': {'y': [1, 2]}}
+    assert base == {'a': {'b': 1}, 'x': {'y': [1]}}
+    assert overlays == [{'a': {'c': 2}}, {'a': {'b': 3}, 'x': {'y': [2]}}]
+    merged = scruffy.config.merge_dicts(base, [{'z': 1}])
+    assert merged['a'] is base['a']
+
+def test_config_strategies():
+    c = Config(defaults={'plugins': ['a'], 'servers': {'x': 1}}, strategies={'plugins': APPEND})
+    c.update({'plugins': ['b']})
+    c.update({'servers': {'y': 2}}, strategies={'servers': REPLACE})
+    assert c.plugins == ['a', 'b']
+    assert c.servers == {'y': 2}
+    c.reset()
+    assert c.plugins == ['a']
+
+    # strategies passed to a node's update() are relative to it
+    c = Config(defaults={'a': {'l': [1]}})
+    c.a.update({'l': [2]}, strategies={'l': APPEND})
+    assert c.a.l == [1, 2]
+    c._set_layer('file', {'a': {'l': [3]}})
+    assert c.a.l == [3, 2]
+
+
+def test_config_diff_patch():
+    shared = {'big': list(range(100))}
+    a = Config({'a': {'b': 1, 'c': 2}, 'd': [1, 2], 'e': 1, 'shared': shared, 'x.y': {'0': 1}})
+    b = Config({'a': {'b': 1, 'c': 3, 'n': {'m': 1}}, 'd': [1, 2, 3], 'e': True, 'shared': shared,
+                'x.y': {'0': 2}})
+    ops = a.diff(b)
+    assert sorted(ops, key=str) == sorted([('set', 'a.c', 3), ('set', 'a.n', {'m': 1}), ('set', 'd', [1, 2, 3]),
+                                           ('set', 'e', True), ('set', ('x.y', '0'), 2)], key=str)
+    assert a.diff(a) == []
+    assert sorted(b.a.diff({'b': 1})) == [('delete', 'c'), ('delete', 'n')]
+    c = Config({'a': {'b': 1, 'c': 2}, 'd': [1, 2], 'e': 1, 'shared': shared, 'x.y': {'0': 1}, 'z': 1})
+    c.apply_patch(c.diff(b))
+    assert c.to_dict() == b.to_dict()
+    a.a.apply_patch(a.a.diff({'b': 2}))
+    assert a.a.to_dict() == {'b': 2}
+    del a['a.b']
+    assert a.a.to_dict() == {}
+    assert_raises(KeyError, a.__delitem__, 'nope')
+    assert_raises(ValueError, a.apply_patch, [('frob', 'a')])
+    assert_raises(TypeError, a.freeze().apply_patch, [])
+
+
+def test_config_delete_replay():
+    c = Config(defaults={'a': {'b': 1, 'c': 2}})
+    del c['a.b']
+    assert 'b' not in c.a
+    c._set_layer('file', {'a': {'c': 3}})
+    assert c.a.to_dict() == {'c': 3}
+    c['a.b'] = 5
+    del c['a.b']
+    assert c._layers['defaults'] == {'a': {'b': 1, 'c': 2}}
+    c.reset()
+    assert c.a.b == 1
+
+
+def test_config_override_growth():
+    c = Config(defaults={'a': {'x': 0}, 'l': [0]}, strategies={'l': APPEND})
+    for i in range(1000):
+        c.update({'a': {'x': i}})
+        c.update({'b': i})
+        c.a.update({'x': i})
+        c.a = {'y': i} if i % 2 else 5
+    assert len(c._overrides) < 5
+    assert len(c._owned) < 100
+    assert c.to_dict() == {'a': {'y': 999}, 'b': 999, 'l': [0]}
+
+    # appending to a list doesn't replace the earlier changes
+    c.update({'l': [1]})
+    c.update({'l': [2]})
+    c._set_layer('file', {'a': {'x': 1, 'z': 2}, 'l': [5]})
+    assert c.to_dict() == {'a': {'y': 999}, 'b': 999, 'l': [0, 5, 1, 2]}
+
+    # an earlier change is kept if something changed since depends on it
+    c = Config(defaults={'a': 1})
+    c.update({'a': {'b': 1}})
+    c['a.c'] = 2
+    c.update({'a': {'b': 2}})
+    c._set_layer('file', {'a': 3})
+    assert c.a == {'b': 2, 'c': 2}
+    c.reset()
+    assert c.a == 3
+
+
+def test_config_fingerprint():
+    c = Config(defaults={'a': {'b': 1, 'c': [1, {'d': 2}]}, 'e': {'f': 'x'}})
+    a, e = c.a.fingerprint(), c.e.fingerprint()
+    root = c.fingerprint()
+    assert c.fingerprint() == root
+    assert Config({'e': {'f': 'x'}, 'a': {'c': [1, {'d': 2}], 'b': 1}}).fingerprint() == root
+    assert c.freeze().fingerprint() == root
+    assert c.freeze().a.fingerprint() == a
+    assert Config({'e': {'f': 'y'}}).e.fingerprint() != e
+    assert Config({'e': {'f': 1}}).e.fingerprint() != Config({'e': {'f': '1'}}).e.fingerprint()
+    c['a.c.1.d'] = 3
+    assert c.a.fingerprint() != a
+    assert c.fingerprint() != root
+    assert c.e.fingerprint() == e
+    c['a.c.1.d'] = 2
+    assert c.a.fingerprint() == a
+    del c['a.c.0']
+    assert c.a.c.fingerprint() == Config({'c': [{'d': 2}]}).c.fingerprint()
+    c.update({'e': {'g': 1}})
+    assert c.e.fingerprint() != e
+    c.reset()
+    assert c.fingerprint() == root
+
+
+def test_config_directory():
+    d = tempfile.mkdtemp()
+    try:
+        for name, text in [('10-base.yaml', 'a: 1\nb: {c: 1, d: 1}\n'), ('20-more.json', '{"b": {"c": 2}}'),
+                           ('30-last.yml', 'b: {d: 3}\n'), ('.hidden.yaml', 'a: 9\n'), ('notes.txt', 'a: 8\n')]:
+            with open(os.path.join(d, name), 'w') as f:
+                f.write(text)
+        defaults = os.path.join(d, '.defaults.yaml')
+        with open(defaults, 'w') as f:
+            f.write('e: 5\n')
+        c = ConfigDirectory(d, defaults=defaults, load=True, workers=4)
+        assert c.to_dict() == {'a': 1, 'b': {'c': 2, 'd': 3}, 'e': 5}
+        assert [f.name for f in c.fragments()] == ['10-base.yaml', '20-more.json', '30-last.yml']
+        assert ConfigDirectory(d, workers=1, load=True).to_dict() == {'a': 1, 'b': {'c': 2, 'd': 3}}
+        assert not c.check()
+        with open(os.path.join(d, '40-new.yaml'), 'w') as f:
+            f.write('a: 4\n')
+        assert c.check()
+        assert c.a == 4
+        assert_raises(TypeError, c.save)
+        assert ConfigDirectory(os.path.join(d, 'nope'), load=True).to_dict() == {}
+    finally:
+        shutil.rmtree(d)
+
+
+def test_config_file_lazy():
+    d = tempfile.mkdtemp()
+    try:
+        defaults = os.path.join(d, 'defaults.yaml')
+        with open(defaults, 'w') as f:
+            f.write('a: {x: 0, y: 0}\nd: 4\n')
+        p = os.path.join(d, 'config.yaml')
+        with open(p, 'w') as f:
+            f.write('a:\n  x: 1\nb: [1, 2]\n"c c": {z: 3}\n')
+        c = ConfigFile(p, defaults=defaults, lazy=True, load=True)
+        doc = c._layers['file']
+        assert isinstance(doc, scruffy.file.LazyDocument)
+        assert doc._sections == {}
+        assert c.query('a.x') == [('a.x', 1)]
+        assert c.a.x == 1
+        assert c.a.y == 0
+        assert list(doc._sections) == ['a']
+        assert c.d == 4
+        c['c c.z'] = 5
+        c.update({'b': [3]})
+        assert c.b == [3]
+        del c['a']
+        assert c.to_dict() == {'b': [3], 'c c': {'z': 5}, 'd': 4}
+        assert not c._pending
+
+        # runtime changes to sections that haven't been loaded are replayed
+        # when they are
+        c.load(reload=True)
+        assert c._pending
+        assert c['c c.z'] == 5
+        assert c.a == None
+        c.reset()
+        assert c.a.x == 1
+
+        calls = []
+        c.subscribe('b', lambda key, old, new: calls.append(new))
+        with open(p, 'w') as f:
+            f.write('{"a": {"x": 2}, "b": [9]}')
+        c.load(reload=True)
+        assert calls == [[9]]
+
+        # subscribing to a section that hasn't been loaded doesn't make
+        # unrelated changes look like changes to it
+        c.load(reload=True)
+        changes = []
+        c.subscribe('a.x', lambda key, old, new: changes.append((old, new)))
+        c.load(reload=True)
+        c.d = 5
+        assert changes == []
+        with open(p, 'w') as f:
+            f.write('{"a": {"x": 3}}')
+        c.load(reload=True)
+        assert changes == [(2, 3)]
+
+        j = os.path.join(d, 'config.json')
+        with open(j, 'w') as f:
+            f.write('{"a": {"x": "}"}, "b": [1, {"c": 2}]}')
+        c = ConfigFile(j, lazy=True, load=True)
+        assert type(c._layers['file']) == dict
+        assert c.b[1].c == 2
+
+        # documents that can't be split up are loaded in full
+        with open(p, 'w') as f:
+            f.write('a: &x {y: 1}\nb: *x\n')
+        c = ConfigFile(p, lazy=True, load=True)
+        assert type(c._layers['file']) == dict
+        assert c.b.y == 1
+        for text in ['a: "foo\nbar: baz"\nc: 1\n', 'a: {x: 1,\nbar: 2}\nc: 1\n']:
+            with open(p, 'w') as f:
+                f.write(text)
+            c = ConfigFile(p, lazy=True, load=True)
+            assert type(c._layers['file']) == dict
+            assert c.to_dict() == yaml.safe_load(text)
+        # rewriting the file in place doesn't affect sections not read yet
+        with open(p, 'w') as f:
+            f.write('a: 1\nb: {c: [%s]}\n' % ', '.join(['2'] * 10000))
+        c = ConfigFile(p, lazy=True, load=True)
+        assert c.a == 1
+        with open(p, 'w') as f:
+            f.write('a: 3\n')
+        assert c.b.c[9999] == 2
+
+        with open(p, 'w') as f:
+            f.write('a: "x y"\nb: [1, {c: \'it\'\'s\'}]  # don\'t\n')
+        c = ConfigFile(p, lazy=True, load=True)
+        assert isinstance(c._layers['file'], scruffy.file.LazyDocument)
+        assert c.b[1].c == "it's"
+    finally:
+        shutil.rmtree(d)
+
+
+def test_config_threadsafe():
+    c = Config(defaults={'a': {'x': 0, 'y': 0}, 'b': {'z': 1}}, threadsafe=True)
+    first = c._data
+    c['a.x'] = 1
+    assert first == {'a': {'x': 0, 'y': 0}, 'b': {'z': 1}}
+    assert c._data['b'] is first['b']
+    assert c.a.x == 1
+    a = c.a.to_dict()
+    c.update({'a': {'y': 1}})
+    assert a == {'x': 1, 'y': 0}
+    assert c.a.y == 1
+
+    errors = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            a = c.a.to_dict()
+            if a['x'] != a['y']:
+                errors.append(a)
+
+    readers = [threading.Thread(target=read) for i in range(4)]
+    for t in readers:
+        t.start()
+    for i in range(2000):
+        c.update({'a': {'x': i, 'y': i}})
+    done.set()
+    for t in readers:
+        t.join()
+    assert errors == []
+    assert c.a.y == 1999
+
+
+def test_config_profiling():
+    c = Config(defaults={'a': {'b': 1, 'c': 2}, 'd': {'e': [1]}, 'f': 3, 'g': {'h': 1}})
+    before = c.a
+    profile = c.start_profiling()
+    for i in range(5):
+        c.a.b
+    c['a.c']
+    c.d.to_dict()
+    c.f = 4
+    del c['f']
+    before.b
+    assert profile.reads == {('a',): 5, ('a', 'b'): 5, ('a', 'c'): 1, ('d',): 1}
+    assert profile.writes == {('f',): 2}
+    assert profile.children == 12
+    assert set(k for k, n, t in profile.hot_keys(2)) == set(['a', 'a.b'])
+    assert profile.never_read() == ['g.h']
+    d = profile.to_dict()
+    assert d['reads'] == 12
+    assert d['writes_by_key'] == {'f': 2}
+    assert json.loads(profile.to_json())['never_read'] == ['g.h']
+    assert c.stop_profiling() is profile
+    assert type(c) == Config
+    c.a.b
+    assert profile.reads[('a', 'b')] == 5
+    assert_raises(TypeError, c.freeze().start_profiling)
+
+    # lists and missing values are read as a whole
+    c = Config(defaults={'servers': [{'host': 'a'}], 'opt': None, 'x': 1})
+    profile = c.start_profiling()
+    c.servers[0]
+    c.opt
+    assert profile.never_read() == ['x']
+
+
+def test_config_compact():
+    data = {'a': [{'tags': ['x', 'y'], 'n': 1.5}, {'tags': ['x', 'y'], 'n': 1.5}], 'b': {'c': 'x'}}
+    c = Config(defaults=data, compact=True)
+    assert c.to_dict() == data
+    layer = c._layers['defaults']
+    assert layer['a'][0]['tags'] is layer['a'][1]['tags']
+    c.a = [{'tags': ['x', 'y', 'z']}, c.a[1].to_dict()]
+    assert c.a[0].tags == ['x', 'y', 'z']
+    assert c.a[1].tags == ['x', 'y']
+    assert layer['a'][0]['tags'] == ['x', 'y']
+    assert data['a'][1]['tags'] == ['x', 'y']
+    assert scruffy.config.compact([1, {'k': 2.0}]) == [1, {'k': 2.0}]
+
+    p = '/tmp/scruffy_compact.json'
+    with open(p, 'w') as f:
+        json.dump(data, f)
+    c = ConfigFile(p, compact=True)
+    c.load()
+    assert c.to_dict() == data
+    os.unlink(p)
+
+
+def test_config_query():
+    c = Config(defaults={'clusters': {'east': {'nodes': [{'port': 1}, {'port': 2}]},
+                                      'west': {'nodes': [{'port': 3}, {'host': 'x'}]}},
+                         'web-1': {'port': 4}, 'db': {'port': 5}})
+    assert c.query('clusters.*.nodes.*.port') == [('clusters.east.nodes.0.port', 1),
+                                                  ('clusters.east.nodes.1.port', 2),
+                                                  ('clusters.west.nodes.0.port', 3)]
+    assert c.query('web-*.port') == [('web-1.port', 4)]
+    assert sorted(v for p, v in c.query('**.port')) == [1, 2, 3, 4, 5]
+    assert c.query('clusters.east.nodes.5') == []
+    [(path, node)] = c.query('clusters.west.nodes.1')
+    assert isinstance(node, ConfigNode) and node.host == 'x'
+    assert c.clusters.query('*.nodes.0.port') == [('east.nodes.0.port', 1), ('west.nodes.0.port', 3)]
+
+    # results are cached until the config changes
+    assert c.query('db.port') is not c.query('db.port')
+    c.db.port = 6
+    assert c.query('db.port') == [('db.port', 6)]
+    del c['clusters.east']
+    assert c.query('clusters.*.nodes.*.port') == [('clusters.west.nodes.0.port', 3)]
+
+    f = c.freeze()
+    assert f.query('clusters.*.nodes.*.port') == [('clusters.west.nodes.0.port', 3)]
+    assert f.query('**.port')[-1] == ('db.port', 6)
+    assert f.query('clusters.west.nodes.1')[0][1].host == 'x'
+    f = Config(defaults={'a': {'b.c': 1, 'b': {'c': 2}, 'd.e': {'f': 3}}}).freeze()
+    assert f.query('a.*') == [(('a', 'b.c'), 1), ('a.b', {'c': 2}), (('a', 'd.e'), {'f': 3})]
+    assert f.query('a.b.*') == [('a.b.c', 2)]
+
+
+def test_config_source():
+    from six.moves import BaseHTTPServer
+
+    doc = {'body': b'{"a": {"x": 1}}', 'etag': '"v1"'}
+    requests = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.headers.get('If-None-Match'))
+            if doc.get('broken'):
+                self.wfile.write(b'garbage\r\n\r\n')
+                return
+            if self.headers.get('If-None-Match') == doc['etag']:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', doc['etag'])
+            self.send_header('Content-Length', str(len(doc['body'])))
+            self.end_headers()
+            self.wfile.write(doc['body'])
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}/config.json'.format(server.server_address[1])
+    d = tempfile.mkdtemp()
+    try:
+        defaults = os.path.join(d, 'defaults.yaml')
+        with open(defaults, 'w') as f:
+            f.write('a: {x: 0, y: 0}\nb: 2\n')
+        local = os.path.join(d, 'local')
+        c = ConfigSource(url, local, defaults=defaults, load=True)
+        assert c.to_dict() == {'a': {'x': 1, 'y': 0}, 'b': 2}
+        assert requests == [None]
+
+        # later loads are conditional
+        c = ConfigSource(url, local, defaults=defaults, load=True)
+        assert c.a.x == 1
+        assert requests == [None, '"v1"']
+        assert not c.check()
+        doc.update(body=b'{"a": {"x": 2}}', etag='"v2"')
+        assert c.check()
+        assert c.a.x == 2
+        assert_raises(TypeError, c.save)
+
+        # the local copy is used if the server sends back garbage
+        doc['broken'] = True
+        assert not c.check()
+        assert c.a.x == 2
+        doc['broken'] = False
+
+        # a recent enough local copy is used without asking
+        count = len(requests)
+        assert ConfigSource(url, local, max_age=60, load=True).a.x == 2
+        assert len(requests) == count
+
+        # the local copy is used while the server is down
+        server.shutdown()
+        server.server_close()
+        c = ConfigSource(url, local, defaults=defaults, load=True)
+        assert c.to_dict() == {'a': {'x': 2, 'y': 0}, 'b': 2}
+        assert not c.check()
+        assert_raises(IOError, ConfigSource, url, os.path.join(d, 'empty'), load=True)
+    finally:
+        shutil.rmtree(d)
@@ -176,3 +176,26 @@ def test_directory_add_file():
 def test_directory_add_file_fail():
     d = Directory('tests/env1')
     d.add(1)
+
+
+def test_yaml_json_file():
+    assert scruffy.file.YamlFile('tests/env1/yaml_config').content == {'setting1': 666, 'setting2': True,
+                                                          'setting3': {'key1': 'value', 'key2': 'value'}}
+    assert scruffy.file.JsonFile('tests/env1/json_file').content == {'setting1': 667, 'setting3': {'key1': 'not value'}}
+
+
+def test_parse():
+    assert scruffy.file.parse('{"a": [1, 2.5, null, true]}', '.json') == {'a': [1, 2.5, None, True]}
+    assert scruffy.file.parse('{a: [1, 2.5, null, true]}', '.json') == {'a': [1, 2.5, None, True]}
+    assert scruffy.file.parse('a:\n\tb: 1\n') == {'a': {'b': 1}}
+    assert scruffy.file.parse('a: "x\ty"', expand_tabs=False) == {'a': 'x\ty'}
+
+
+def test_yaml_file_tabs():
+    p = '/tmp/scruffy_test_tabs.yaml'
+    with open(p, 'w') as f:
+        f.write('a: "x\ty"\n')
+    try:
+        assert scruffy.file.YamlFile(p).content == {'a': 'x\ty'}
+    finally:
+        os.unlink(p)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import *
+from scruffy import *
+
+
+SCHEMA = {
+    'server': {
+        'host': Field(str, required=True),
+        'port': Field(int, default=8080, min=1, max=65535),
+        'debug': bool,
+    },
+    'level': Field(str, choices=['debug', 'info']),
+    'backends': [{'url': Field(str, required=True), 'weight': float}]
+}
+
+
+def test_schema_check():
+    s = Schema(SCHEMA)
+    data = {'server': {'host': 'x', 'debug': 'yes'}, 'backends': [{'url': 'a', 'weight': 2}], 'other': 1}
+    changes = s.check(data)
+    assert sorted(changes, key=str) == [(('backends', 0, 'weight'), 2.0), (('server', 'debug'), True),
+                                         (('server', 'port'), 8080)]
+    v = s.validate(data)
+    assert v == {'server': {'host': 'x', 'debug': True, 'port': 8080}, 'backends': [{'url': 'a', 'weight': 2.0}],
+                 'other': 1}
+    assert data['server'] == {'host': 'x', 'debug': 'yes'}
+    assert s.validate({'server': {'host': 'x'}}) == {'server': {'host': 'x', 'port': 8080}}
+
+
+def test_schema_errors():
+    s = Schema(SCHEMA)
+    try:
+        s.check({'server': {'port': 'abc', 'debug': [1]}, 'level': 'loud', 'backends': [{}, 1]})
+        assert False
+    except SchemaError as e:
+        assert isinstance(e, ValueError)
+        assert sorted(e.errors) == [
+            ('backends.0.url', 'missing required value'),
+            ('backends.1', 'expected a section, got int'),
+            ('level', "'loud' is not one of ['debug', 'info']"),
+            ('server.debug', 'expected bool, got [1]'),
+            ('server.host', 'missing required value'),
+            ('server.port', "expected int, got 'abc'"),
+        ]
+    assert_raises(SchemaError, s.check, {'server': {'host': 'x', 'port': 0}})
+    assert_raises(SchemaError, s.check, {'server': {'host': 'x'}, 'backends': {}})
+    assert_raises(SchemaError, s.check, {})
+    assert_raises(TypeError, Schema, {'a': 1})
+
+
+def test_schema_type_tuple():
+    s = Schema({'a': (int, float), 'b': Field((int, str), min=2)})
+    assert s.check({'a': 1, 'b': 'xy'}) == []
+    assert s.check({'a': 1.5, 'b': 3}) == []
+    assert s.check({'a': '2.5'}) == [(('a',), 2.5)]
+    try:
+        s.check({'a': 'x'})
+        assert False
+    except SchemaError as e:
+        assert e.errors == [('a', "expected int or float, got 'x'")]
+    assert_raises(TypeError, Schema, {'a': (int, 1)})
+
+
+def test_config_validate():
+    c = Config({'server': {'host': 'x', 'port': '81'}})
+    c.validate(SCHEMA)
+    assert c.server.port == 81
+    assert c['server.port'] == 81
+    c.server.port = 'abc'
+    assert_raises(SchemaError, c.validate, SCHEMA)
+    c = Config(schema={'a': Field(int, default=1)})
+    assert c.a == 1
+    c.a = '2'
+    assert c.validate().a == 2
+    c.reset()
+    assert c.a == 1
+    f = c.freeze()
+    assert f.validate({'a': int}) is f
+    assert_raises(TypeError, f.validate, {'b': Field(int, default=1)})
+
+
+def test_config_file_schema():
+    d = tempfile.mkdtemp()
+    try:
+        p = os.path.join(d, 'config.yaml')
+        with open(p, 'w') as f:
+            f.write('server:\n  host: x\n  port: "81"\n')
+        c = ConfigFile(p, schema=SCHEMA, load=True)
+        assert c.server.port == 81
+        assert c.server.host == 'x'
+        with open(p, 'w') as f:
+            f.write('server:\n  port: 82\n')
+        assert_raises(SchemaError, c.load, True)
+        assert c.server.port == 81
+
+        # the bad file isn't kept, and is tried again until it's fixed
+        c.reset()
+        assert c.server.port == 81
+        assert_raises(SchemaError, c.check)
+        with open(p, 'w') as f:
+            f.write('server:\n  host: y\n')
+        assert c.check()
+        assert c.server.to_dict() == {'host': 'y', 'port': 8080}
+    finally:
+        shutil.rmtree(d)
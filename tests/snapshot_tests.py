@@ -0,0 +1,93 @@
+import os
+import datetime
+import shutil
+import struct
+import tempfile
+import multiprocessing
+import subprocess
+import sys
+
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+from scruffy import *
+import scruffy.snapshot
+
+
+def test_snapshot():
+    d = tempfile.mkdtemp()
+    try:
+        p = os.path.join(d, 'config.snap')
+        data = {'a': {'b': [1, 2.5, None, True], 'c': u'x'}, 'd': 1, 'e': {'when': datetime.date(2020, 1, 2)}}
+        Config(defaults=data).dump_snapshot(p)
+        c = Config.load_snapshot(p)
+        doc = c._layers['defaults']
+        assert isinstance(doc, scruffy.snapshot.SnapshotDocument)
+        assert c.a.b[1] == 2.5
+        assert list(doc._sections) == ['a']
+        assert c.e.when == datetime.date(2020, 1, 2)
+        assert c.to_dict() == data
+        c.a.c = 'y'
+        c.reset()
+        assert c.a.c == 'x'
+        assert Config.load_snapshot(p, {'d': 2}).d == 2
+        assert c.a.freeze().to_dict() == data['a']
+
+        with open(p, 'r+b') as f:
+            f.seek(8)
+            f.write(struct.pack('<H', 99))
+        assert_raises(ValueError, Config.load_snapshot, p)
+        with open(p, 'wb') as f:
+            f.write(b'not a snapshot')
+        assert_raises(ValueError, Config.load_snapshot, p)
+        assert_raises(TypeError, scruffy.snapshot.dump, [1], p)
+    finally:
+        shutil.rmtree(d)
+
+
+def _read_shared(name, queue):
+    c = Config.attach_snapshot(name)
+    queue.put((c.a.b, c['c.1'], list(c._layers['defaults']._sections)))
+
+
+def test_shared_snapshot():
+    if not scruffy.snapshot.HAVE_SHARED_MEMORY:
+        raise SkipTest
+    shm = Config(defaults={'a': {'b': 1}, 'c': [1, 2], 'd': {'e': 3}}).share_snapshot()
+    try:
+        for method in ['fork', 'spawn']:
+            if method not in multiprocessing.get_all_start_methods():
+                continue
+            ctx = multiprocessing.get_context(method)
+            queue = ctx.Queue()
+            p = ctx.Process(target=_read_shared, args=(shm.name, queue))
+            p.start()
+            assert queue.get(timeout=10) == (1, 2, ['a', 'c'])
+            p.join()
+        c = Config.attach_snapshot(shm.name)
+        assert c.to_dict() == {'a': {'b': 1}, 'c': [1, 2], 'd': {'e': 3}}
+
+        # an unrelated process attaching and exiting leaves it in place
+        script = 'import scruffy; print(scruffy.Config.attach_snapshot({!r}).a.b)'.format(shm.name)
+        for i in range(2):
+            out = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.STDOUT)
+            assert out.strip() == b'1'
+        assert Config.attach_snapshot(shm.name).d.e == 3
+
+        # children started with spawn share the resource tracker, and leave
+        # the creator's registration in it
+        script = '\n'.join([
+            'import multiprocessing, scruffy, scruffy.snapshot',
+            'shm = scruffy.Config(defaults={"a": 1}).share_snapshot()',
+            'ctx = multiprocessing.get_context("spawn")',
+            'p = ctx.Process(target=scruffy.snapshot.attach, args=(shm.name,))',
+            'p.start()',
+            'p.join()',
+            'shm.close()',
+            'shm.unlink()',
+            'print(p.exitcode)',
+        ])
+        out = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.STDOUT)
+        assert out.strip() == b'0'
+    finally:
+        shm.close()
+        shm.unlink()